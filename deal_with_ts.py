@@ -1,283 +1,719 @@
 #!/usr/bin/env python3
 
-import pandas as pd
+import hashlib
+import json
 import os
 from argparse import ArgumentParser
-from ast import literal_eval
-from Bio import SeqIO
+from collections import namedtuple
+from functools import partial
+from ts_cache import SiteCache, cache_key, file_fingerprint
+from ts_coverage import coverage_source, open_coverage
+from ts_lazy import lazy_import
+from ts_pool import imap_forked, map_forked, shared, sharing
+from ts_profile import profiling, stage
+from ts_reference import Reference
+from ts_sites import (FEATURE, NO_FEATURE, TEMPLATE_SWITCHING, SiteTable,
+                      concat_sites, count_dtype, feature_labels,
+                      position_dtype)
+from ts_stream import contig_blocks, count_contig, read_block
+from ts_table import EXTENSIONS, TableWriter, read_table
 
-def get_cov(position, cov_dict):
-    """
-    Calculates coverage based on a cov_dict
-    """
-    if position in cov_dict:
-        return cov_dict.get(position)
-    else:
-        return 0
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# The number of rows of site tables that are converted to a dataframe and
+# written to a tsv summary table at once
+WRITE_ROWS = 100000
+
+# The settings of one strand pass. The coverage and reference stores and the
+# limit table can be shared between passes.
+PassConfig = namedtuple("PassConfig", ["feature_file",
+                                       "coverage_file",
+                                       "reference",
+                                       "dictionary",
+                                       "feature",
+                                       "strand",
+                                       "minimum",
+                                       "wobble",
+                                       "ratio",
+                                       "multiplier",
+                                       "distance",
+                                       "cov_sample",
+                                       "check_surroundings",
+                                       "threads",
+                                       "cache_dir",
+                                       "cache_size",
+                                       "streaming",
+                                       "incremental",
+                                       "intermediate_format",
+                                       "coverage_store",
+                                       "reference_store",
+                                       "limits"])
 
 def coverage(pos_list, args, contig):
     """
     Calculates average coverages from a given distance for a list of positions
     """
-    cols = ["contig", "pos", "count"]
-    cov = pd.read_csv(args.coverage_file, sep = "\t", names= cols)
-    cov = cov.loc[cov.contig == contig]
-    cov["pos"] = cov["pos"].astype(int)
-    cov["count"] = cov["count"].astype(int)
-    cov.set_index("pos", drop=True, inplace=True)
-    cov_dict = cov.to_dict()["count"]
-    coverages = []
-    for pos in pos_list:
-        to_avg = []
-        if args.distance > args.cov_sample:
-            for position in range(pos + args.distance - args.cov_sample,
-                                  pos + args.distance):
-                to_avg.append(get_cov(position, cov_dict))
-        elif args.distance < args.cov_sample:
-            for position in range(pos + args.distance,
-                                  pos + args.distance - args.cov_sample):
-                to_avg.append(get_cov(position, cov_dict))
-        else:
-            to_avg.append(get_cov(pos + args.distance, cov_dict))
-        coverages.append(sum(to_avg)/len(to_avg))
-    return coverages
-
-def check_if_qualified(df, minimum, ratio):
+    pos = np.asarray(pos_list, dtype=np.int64)
+    if args.distance > args.cov_sample:
+        start = args.distance - args.cov_sample
+        end = args.distance
+    elif args.distance < args.cov_sample:
+        start = args.distance
+        end = args.distance - args.cov_sample
+    else:
+        start = args.distance
+        end = args.distance + 1
+    if end <= start:
+        raise ValueError("The absolute value of cov_sample has to be smaller "
+                         "than or equal to the value of distance.")
+    sums = args.coverage_store.window_sums(contig, pos + start, pos + end)
+    return sums / (end - start)
+
+def check_if_qualified(table, minimum, ratio):
     """
     Checks whether the feature position satisfies the minimum count and minimum
     ratio of coverage requirements.
     """
-    qual_list = []
-    for index, row in df.iterrows():
-        is_qual = (row["count"] >= minimum
-                   and row["ratio"] >= ratio
-                   and row["is_picked"])
-        qual_list.append(is_qual)
-    return qual_list
+    return np.asarray((table["count"] >= minimum)
+                      & (table["ratio"] >= ratio)
+                      & table["is_picked"], dtype=bool)
 
-def pick_from_greatests(dictionary, wobble):
+def pick_from_greatests(positions, is_greatest, wobble):
     """
     Picks the left- or rightmost positions of the greatests list in a window
     determined by the wobble size. Whether the left or the rightmost positions
     are desired can be set by the user, and the list is ordered accordingly.
     """
-    previous = -100
-    is_picked_list = []
-    for pos, is_greatest in dictionary.items():
-        is_picked = False
-        if is_greatest:
-            if previous not in range(pos - wobble, pos + wobble + 1):
-                is_picked = True
-            previous = pos
-        is_picked_list.append(is_picked)
-    return is_picked_list
-
-def get_As(seq_record, position, args):
-    if args.strand < 0:
-        c = 1
-        d = 19
+    is_greatest = np.asarray(is_greatest, dtype=bool)
+    greatests = np.asarray(positions, dtype=np.int64)[is_greatest]
+    previous = np.concatenate(([-100], greatests[:-1]))
+    is_picked = np.zeros(len(is_greatest), dtype=bool)
+    is_picked[is_greatest] = np.abs(greatests - previous) > wobble
+    return is_picked
+
+def count_As(codes, strand):
+    """
+    Counts the adenine content of a matrix of 20-nt windows given as uint8
+    character codes in the order in which they are read, starting next to
+    the polyA site. Each A counts as +1 and other nucleotides as -1, the
+    counter stops after it first reaches -1 and its highest value, but at
+    least 0, is the A count. Codes of 0 mark the end of the sequence. On the
+    reverse strand the windows are read from the forward sequence, so the
+    complementary Ts count as As.
+    """
+    if strand < 0:
+        is_A = np.isin(codes | 0x20, [ord("t"), ord("u")])
     else:
-        c = 20
-        d = 0
-    seq = seq_record.seq[position - c:position + d].lower()
+        is_A = (codes | 0x20) == ord("a")
+    inside = codes != 0
+    counter = np.cumsum(np.where(is_A, 1, -1) * inside, axis=1)
+    negative = counter < 0
+    stopped = (np.cumsum(negative, axis=1) - negative) > 0
+    counted = np.where(inside & ~stopped, counter, 0)
+    return np.maximum(counted.max(axis=1, initial=0), 0)
+
+def get_As(reference, contig, positions, args):
+    """
+    Returns the A counts of the 20 nucleotides upstream of each position of
+    a contig. The counts are looked up in the A count track of the reference
+    if there is one.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    track = reference.a_track(contig, args.strand)
+    if (track is not None and len(positions) and positions.min() >= 0
+            and positions.max() < len(track)):
+        return track[positions].astype(np.int64)
+    steps = np.arange(20)
     if args.strand < 0:
-        seq = seq.reverse_complement()
-    countAs = 0
-    count_list = []
-    for char in seq[::-1]:
-        if char == "a":
-            countAs += 1
-            count_list.append(countAs)
-        else:
-            countAs += -1
-            count_list.append(countAs)
-        if countAs < 0:
-            break
-    countAs = max(count_list)
-    if countAs < 0:
-        countAs = 0
-    return countAs
-
-def check_if_greatest(tuples, wobble):
+        window = positions[:, None] - 1 + steps
+    else:
+        window = positions[:, None] - 1 - steps
+    return count_As(reference.bases(contig, window), args.strand)
+
+def window_bounds(positions, window):
+    """
+    Sorts the positions and returns the sorting order and the [low, high)
+    index bounds of the +/- window of each sorted position.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    order = np.argsort(positions, kind="stable")
+    sorted_pos = positions[order]
+    low = np.searchsorted(sorted_pos, sorted_pos - window, side="left")
+    high = np.searchsorted(sorted_pos, sorted_pos + window, side="right")
+    return order, low, high
+
+def check_if_greatest(positions, counts, wobble):
     """
     Finds the feature position with the highest read support in a window
-    determined by the wobble size.
-    """
-    is_greatest_list = []
-    for tup in tuples:
-        pos, count = tup
-        for position, count2 in tuples:
-            is_greatest = True
-            if position in range(pos - wobble, pos + wobble + 1):
-                is_greatest = count >= count2
-                if not is_greatest:
-                    break
-        is_greatest_list.append(is_greatest)
-    return is_greatest_list
-
-def count_average(tuples, window):
-    in_window = []
-    for tup in tuples:
-        pos, count = tup
-        hundred = 0
-        for position, count2 in tuples:
-            if position in range(pos - window, pos + window + 1):
-                hundred += count2
-        in_window.append(hundred/(2 * window + 1))
+    determined by the wobble size. The window maxima are read from a sparse
+    table of the sorted counts, which only has to be as deep as the widest
+    window.
+    """
+    order, low, high = window_bounds(positions, wobble)
+    counts = np.asarray(counts)[order]
+    is_greatest = np.zeros(len(order), dtype=bool)
+    if len(order) == 0:
+        return is_greatest
+    levels = np.floor(np.log2(high - low)).astype(np.int64)
+    table = [counts]
+    for level in range(1, levels.max() + 1):
+        previous = table[-1]
+        half = 1 << (level - 1)
+        table.append(np.maximum(previous[:-half], previous[half:]))
+    window_max = np.empty(len(order), dtype=counts.dtype)
+    for level in np.unique(levels):
+        at_level = levels == level
+        row = table[level]
+        window_max[at_level] = np.maximum(
+                row[low[at_level]],
+                row[high[at_level] - (1 << level)])
+    is_greatest[order] = counts >= window_max
+    return is_greatest
+
+def count_average(positions, counts, window):
+    """
+    Averages the read counts in a +/- window around each position using
+    prefix sums of the sorted counts.
+    """
+    order, low, high = window_bounds(positions, window)
+    cumulative = np.concatenate(([0], np.cumsum(np.asarray(counts)[order],
+                                                 dtype=np.int64)))
+    in_window = np.empty(len(order), dtype=np.float64)
+    in_window[order] = (cumulative[high] - cumulative[low]) / (2 * window + 1)
     return in_window
 
-def get10(df, countfile, args):
-    count_dict = {}
+def parse_counts(lines):
+    """
+    Parses ('contig', position)<tab>count lines into a dict of contig:
+    (sorted int32 positions, counts) arrays. The counts have the smallest
+    unsigned type that holds them.
+    """
+    positions = {}
+    counts = {}
+    for line in lines:
+        fields = line.split("\t")
+        if len(fields) < 2:
+            continue
+        contig, pos = fields[0].strip()[1:-1].rsplit(",", 1)
+        contig = contig.strip()[1:-1]
+        positions.setdefault(contig, []).append(int(pos))
+        counts.setdefault(contig, []).append(int(fields[1]))
+    count_store = {}
+    for contig in positions:
+        pos = np.array(positions[contig], dtype=np.int64)
+        count = np.array(counts[contig], dtype=np.int64)
+        order = np.argsort(pos, kind="stable")
+        count_store[contig] = (pos[order].astype(position_dtype(pos)),
+                               count[order].astype(count_dtype(count)))
+    return count_store
+
+def read_counts(countfile):
+    """
+    Parses a LoRTIA count file into a dict of contig: (sorted positions,
+    counts) arrays.
+    """
     with open(countfile) as cfile:
-        for line in cfile:
-            count_dict[eval(line.split("\t")[0])] = int(line.split("\t")[1])
-    dictio = {}
-    sums = []
-    for index, row in df.iterrows():
-        a = []
-        for pos in range(row["pos"] - args.check_surroundings, row["pos"] 
-                         + args.check_surroundings + 1):
-            if (row["contig"], pos) in count_dict:
-                a.append(count_dict[row["contig"], pos])
-            else:
-                a.append(0)
-        if args.feature in ["r5", "l3"]:
-                a = a[::-1]
-        dictio[row["pos"]] = a
-        sums.append(sum(a))
-    dictio = pd.DataFrame(dictio).T
-    if countfile == args.feature_file:
-        mark = "f"
-    else:
-        mark = "r"
-    dictio = dictio.rename(columns=lambda x: mark + str(x - args.check_surroundings))
-    dictio["pos"] = dictio.index
-    df = df.merge(dictio, how="left", on="pos")
-    df["{}sum".format(mark)] = sums
-    return df
+        return parse_counts(cfile)
+
+def read_contig_counts(countfile, blocks, contig):
+    """
+    Parses only the lines of one contig of a count file that is sorted by
+    contig.
+    """
+    if contig not in blocks:
+        return {}
+    return parse_counts(read_block(countfile, blocks[contig]).decode()
+                        .splitlines())
+
+def get10(table, count_store, mark, args):
+    """
+    Adds the read counts of the +/- check_surroundings window of each
+    position as the [mark] matrix, which is written as the
+    [mark]-10...[mark]10 columns and their sum as [mark]sum.
+    """
+    offsets = np.arange(-args.check_surroundings, args.check_surroundings + 1)
+    if args.feature in ["r5", "l3"]:
+        offsets = offsets[::-1]
+    dtype = np.result_type(np.uint8, *[count_store[contig][1].dtype
+                                       for contig in table.contigs
+                                       if contig in count_store])
+    positions = table["pos"].astype(np.int64)
+    windows = np.zeros((len(table), len(offsets)), dtype=dtype)
+    for contig, rows in table.contig_rows():
+        if contig not in count_store:
+            continue
+        count_pos, count = count_store[contig]
+        query = positions[rows, None] + offsets
+        index = np.minimum(np.searchsorted(count_pos, query),
+                           len(count_pos) - 1)
+        windows[rows] = np.where(count_pos[index] == query, count[index], 0)
+    table[mark] = windows
+    return table
+
+def sort_sites(table, feature):
+    """
+    Sorts the positions of a left feature from left to right and those of a
+    right feature from right to left.
+    """
+    order = np.argsort(table["pos"], kind="stable")
+    if feature != "l5" and feature != "l3":
+        order = order[::-1]
+    return table.take(order)
+
+def add_coverages(table, args, contig):
+    table["coverage_before"] = coverage(table["pos"], args, contig)
+    inward = args._replace(distance=args.distance * -1,
+                           cov_sample=args.cov_sample * -1)
+    table["coverage_after"] = coverage(table["pos"], inward, contig)
+    return table
+
+def add_greatest(table, args):
+    positions = table["pos"]
+    counts = table["count"]
+    table["average"] = count_average(positions, counts, 50)
+    table["is_greatest"] = check_if_greatest(positions, counts, args.wobble)
+    table["is_picked"] = pick_from_greatests(positions, table["is_greatest"],
+                                             args.wobble)
+    table["is_qualified"] = check_if_qualified(table, args.minimum,
+                                               args.ratio)
+    return table
 
-def contig_ends(df, args, contig):
+def add_windows(table, args, ts_counts, non_ts_counts):
+    table = get10(table, ts_counts, "f", args)
+    return get10(table, non_ts_counts, "r", args)
+
+def contig_ends(table, args, contig, ts_counts, non_ts_counts):
     """
-    Processes the dataframe for one contig looking for TSSs or TESs.
+    Processes the site table of one contig looking for TSSs or TESs.
     """
-    df["pos"] = pd.to_numeric(df["pos"])
-    if args.feature == "l5" or args.feature == "l3":
     # This makes sure that the leftmost position is taken for each left feature
-        df = df.sort_values(by="pos")
+    table = sort_sites(table, args.feature)
+    with stage("coverage", contig, len(table), feature=args.feature):
+        table = add_coverages(table, args, contig)
+    with stage("greatest", contig, len(table), feature=args.feature):
+        table = add_greatest(table, args)
+    with stage("get10", contig, len(table), feature=args.feature):
+        table = add_windows(table, args, ts_counts, non_ts_counts)
+    return table
+
+def limit_table(dictionary_file):
+    """
+    Reads the limits of the dictionary file into an array indexed by the
+    A count. The limits are looked up by the A_count column, so the rows can
+    be in any order. A counts missing from the file have no limit (NaN).
+    """
+    dictionary_df = pd.read_csv(dictionary_file, sep = "\t", )
+    for column in ["A_count", "limit"]:
+        if column not in dictionary_df.columns:
+            raise ValueError("The dictionary {} has no {} column.".format(
+                             dictionary_file, column))
+    if len(dictionary_df) == 0:
+        raise ValueError("The dictionary {} is empty.".format(
+                         dictionary_file))
+    a_counts = pd.to_numeric(dictionary_df["A_count"], errors="coerce")
+    if (a_counts.isna().any() or (a_counts < 0).any()
+            or (a_counts % 1 != 0).any()):
+        raise ValueError("The A counts of the dictionary {} have to be "
+                         "non-negative integers.".format(dictionary_file))
+    if a_counts.duplicated().any():
+        raise ValueError("The dictionary {} has more than one limit for an "
+                         "A count.".format(dictionary_file))
+    a_counts = a_counts.to_numpy(dtype=np.int64)
+    limits = np.full(a_counts.max() + 1, np.nan)
+    limits[a_counts] = dictionary_df["limit"].to_numpy(dtype=np.float64)
+    return limits
+
+def site_As(table, args, rows):
+    """
+    Counts the As upstream of the selected rows. The other rows get -2.
+    """
+    A_list = np.full(len(table), -2, dtype=np.int8)
+    positions = table["pos"]
+    for contig, contig_rows in table.contig_rows():
+        selected = rows & contig_rows
+        if selected.any():
+            A_list[selected] = get_As(args.reference_store, contig,
+                                      positions[selected], args)
+    return A_list
+
+def decide(table, A_list, qualified, multiplier, limits):
+    """
+    Decides whether the qualified positions are features or
+    template-switching artefacts and returns their feature codes. The other
+    positions get NO_FEATURE.
+    """
+    limit = np.full(len(table), np.nan)
+    known = (A_list >= 0) & (A_list < len(limits))
+    limit[known] = limits[A_list[known]]
+    rsum = table["rsum"]
+    fsum = table["fsum"]
+    before = table["coverage_before"]
+    after = table["coverage_after"]
+    multiplier = np.where(rsum > 1, multiplier, 0)
+    # this avoids division by 0 in the next lines:
+    zero = before == 0
+    is_feature = (((rsum + fsum) * 100 > before - after)
+                  & ((rsum * multiplier >= fsum)
+                     | ((rsum + fsum) / (before + zero) > limit)))
+    codes = np.where(is_feature, FEATURE, TEMPLATE_SWITCHING).astype(np.uint8)
+    codes[~qualified] = NO_FEATURE
+    return codes
+
+def classify(table, args, limits):
+    """
+    Counts the As upstream of the qualified positions and decides whether
+    they are features or template-switching artefacts.
+    """
+    qualified = np.asarray(table["is_qualified"], dtype=bool)
+    contig = table.contigs[0] if len(table) else None
+    with stage("A-count", contig, int(qualified.sum()),
+               feature=args.feature):
+        A_list = site_As(table, args, qualified)
+    with stage("classification", contig, len(table), feature=args.feature):
+        table["A_list"] = A_list
+        table["feature"] = decide(table, A_list, qualified, args.multiplier,
+                                  limits)
+    return table
+
+def process_contig(contig):
+    """
+    Processes the positions of one contig using the data shared by
+    site_table.
+    """
+    args = shared["args"]
+    cache = shared["cache"]
+    table = None
+    if cache is not None:
+        key = cache_key(shared["stage_key"], contig)
+        with stage("cache", contig, feature=args.feature) as record:
+            table = cache.get(key)
+            record["hit"] = table is not None
+    if table is None:
+        if shared["non_ts_counts"] is None:
+            # the table was in the cache when the run started, but it could
+            # not be loaded
+            with stage("read counts", contig, feature=args.feature):
+                shared["non_ts_counts"] = read_counts(
+                    args.feature_file.replace("_ts", ""))
+        positions, counts = shared["ts_counts"][contig]
+        table = contig_ends(SiteTable.from_counts(contig, positions, counts),
+                            args, contig, shared["ts_counts"],
+                            shared["non_ts_counts"])
+        if cache is not None:
+            cache.put(key, table)
     else:
-        df = df.sort_values(by="pos", ascending=False)
-    df["coverage_before"] = coverage(df["pos"], args, contig)
-    args.distance = args.distance * -1
-    args.cov_sample = args.cov_sample * -1
-    df["coverage_after"] = coverage(df["pos"], args, contig)
-    pos_count = list(zip(df["pos"], df["count"]))
-    df["average"] = count_average(pos_count, 50)
-    df["is_greatest"] = check_if_greatest(pos_count, args.wobble)
-    greatests_dict = dict(zip(df["pos"], df["is_greatest"]))
-    df["is_picked"] = pick_from_greatests(greatests_dict, args.wobble)
-    df["ratio"] = df["count"] / df["coverage_before"]
-    df["is_qualified"] = check_if_qualified(df, args.minimum, args.ratio)
-    df = get10(df, args.feature_file, args)
-    df = get10(df, args.feature_file.replace("_ts", ""), args)
-    args.distance = args.distance * -1
-    args.cov_sample = args.cov_sample * -1
-    return df
+        # the cached table may have been qualified with other thresholds
+        table["is_qualified"] = check_if_qualified(table, args.minimum,
+                                                   args.ratio)
+    return shared["finish"](table)
 
-def find_features(args):
+def stage_key(args):
     """
-    Reads in a dataframe from csv, chops it and processes it on contigs.
-    """
-    dictionary_df = pd.read_csv(args.dictionary, sep = "\t", )
-    dictionary = dictionary_df.to_dict()
-    df = pd.read_csv(args.feature_file, sep = "\t", names = ["pos", "count"])
-    df["pos"] = df["pos"].apply(literal_eval)
-    df[["contig", "pos"]] = df["pos"].apply(pd.Series)
-    contig_set = list(set(df.contig))
-    new_df = ()
-    for contig in contig_set:
-        current_df = df.loc[df.contig == contig].copy()
-        current_df = contig_ends(current_df, args, contig)
-        if len(new_df) != 0:
-            new_df = pd.concat([new_df, current_df])
-        else:
-            new_df = current_df
-    feat_list = []
-    cont_name = 0
-    cont = 0
-    A_list = []
-    for index, row in new_df.iterrows():
-        if row["is_qualified"]:
-            if cont_name == row["contig"]:
-                countAs = get_As(cont, row["pos"], args)
-            else:
-                for seq_record in SeqIO.parse(args.reference, "fasta"):
-                    if seq_record.name == row["contig"]:
-                        countAs = get_As(seq_record, row["pos"], args)
-                        cont_name = seq_record.name
-                        cont = seq_record
-                        break
-            if row["rsum"] > 1:
-                multiplier = args.multiplier
-            else:
-                multiplier = 0
-            limit = dictionary["limit"].get(countAs)
-            # this avoids division by 0 in the next lines:
-            if row["coverage_before"] == 0:
-                zero = 1
-            else:
-                zero = 0
-            if ((row["rsum"] + row["fsum"]) * 100 > row["coverage_before"] 
-                    - row["coverage_after"]) and ((row["rsum"] 
-                    * multiplier >= row["fsum"]) or (((row["rsum"] 
-                    + row["fsum"])/(row["coverage_before"] + zero)) > limit)):
-                if args.feature[1] == "3":
-                    feat = "tes"
-                else:
-                    feat = "tss"
-            else:
-                if args.feature[1] == "3":
-                    feat = "Template-switching"
+    Returns the inputs and parameters that the table of contig_ends depends
+    on, apart from the minimum and ratio thresholds.
+    """
+    return [file_fingerprint(args.feature_file),
+            file_fingerprint(args.feature_file.replace("_ts", "")),
+            file_fingerprint(coverage_source(args.coverage_file)),
+            args.feature,
+            args.wobble,
+            args.distance,
+            args.cov_sample,
+            args.check_surroundings]
+
+def site_table(args, finish, contigs=None, counts=None):
+    """
+    Reads in the positions of the feature file and processes them on
+    contigs. The finish function is applied to the site table of each
+    contig, and the tables are returned. If a cache directory is set, the
+    processed tables are reused from and saved to the cache, which is
+    trimmed to its size limit once all contigs are processed. The ts and
+    non-ts count stores that were already read can be given instead of the
+    files, along with the contigs to process.
+    """
+    if counts is None:
+        with stage("read counts", feature=args.feature) as record:
+            ts_counts = read_counts(args.feature_file)
+            record["rows"] = sum(len(positions) for positions, count
+                                 in ts_counts.values())
+        non_ts_counts = None
+    else:
+        ts_counts, non_ts_counts = counts
+    if contigs is None:
+        contigs = list(set(ts_counts))
+    cache = None
+    key = None
+    missing = contigs
+    if args.cache_dir:
+        cache = SiteCache(args.cache_dir, args.cache_size * 1024 ** 2)
+        key = stage_key(args)
+        missing = [contig for contig in contigs
+                   if not os.path.exists(cache.path(cache_key(key, contig)))]
+    if missing and non_ts_counts is None:
+        with stage("read counts", feature=args.feature):
+            non_ts_counts = read_counts(args.feature_file.replace("_ts",
+                                                                  ""))
+    with sharing(args=args,
+                 ts_counts=ts_counts,
+                 non_ts_counts=non_ts_counts,
+                 cache=cache,
+                 stage_key=key,
+                 finish=finish):
+        tables = map_forked(process_contig, contigs, args.threads)
+    if cache is not None:
+        with stage("cache evict", feature=args.feature):
+            cache.evict()
+    return tables
+
+def stream_contig(contig):
+    """
+    Reads and processes the positions of one contig of contig-sorted inputs.
+    """
+    args = shared["args"]
+    with stage("read counts", contig, feature=args.feature):
+        ts_counts = read_contig_counts(args.feature_file,
+                                       shared["ts_blocks"], contig)
+        non_ts_counts = read_contig_counts(
+            args.feature_file.replace("_ts", ""), shared["non_ts_blocks"],
+            contig)
+    positions, counts = ts_counts[contig]
+    table = contig_ends(SiteTable.from_counts(contig, positions, counts),
+                        args, contig, ts_counts, non_ts_counts)
+    return shared["finish"](table)
+
+def stream_features(args, finish):
+    """
+    Processes feature and count files that are sorted by contig one contig
+    at a time and appends the processed tables to the summary table, so
+    that only the contigs of one batch of written rows are in memory at
+    once.
+    """
+    ts_blocks = contig_blocks(args.feature_file, count_contig)
+    with sharing(args=args,
+                 ts_blocks=ts_blocks,
+                 non_ts_blocks=contig_blocks(
+                     args.feature_file.replace("_ts", ""), count_contig),
+                 finish=finish):
+        write_sites(args, imap_forked(stream_contig, list(ts_blocks),
+                                      args.threads))
+
+def batches(tables, rows):
+    """
+    Groups the site tables into lists of consecutive tables of at least the
+    given number of rows, apart from the last list.
+    """
+    batch = []
+    size = 0
+    for table in tables:
+        batch.append(table)
+        size += len(table)
+        if size >= rows:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+def write_sites(args, tables, kept=None):
+    """
+    Writes the summary table. The rows of the contigs that are kept from an
+    earlier table are written first, then the site tables, which are only
+    converted to dataframes here. A parquet table is written contig by
+    contig, so that every contig has its own row group, while the tables of
+    a tsv are concatenated up to WRITE_ROWS rows and written together.
+    """
+    labels = feature_labels(args.feature)
+    is_parquet = args.intermediate_format == "parquet"
+    with TableWriter(output_file(args), args.intermediate_format) as writer:
+        if kept is not None:
+            with stage("write", rows=len(kept), feature=args.feature):
+                if is_parquet:
+                    for contig, group in kept.groupby("contig", sort=False):
+                        writer.write(group)
                 else:
-                    feat = "tss Template-switching"
-        else:
-            feat = None
-            countAs = -2
-        feat_list.append(feat)
-        A_list.append(countAs)
-    new_df["A_list"] = A_list
-    new_df["feature"] = feat_list
+                    writer.write(kept)
+        if is_parquet:
+            for table in tables:
+                with stage("write", table.contigs[0], len(table),
+                           feature=args.feature):
+                    writer.write(table.to_frame(labels))
+            return
+        for batch in batches(tables, WRITE_ROWS):
+            table = concat_sites(batch)
+            with stage("write", rows=len(table), feature=args.feature):
+                writer.write(table.to_frame(labels))
+
+def output_file(args):
+    """
+    Returns the name of the summary table of a feature file.
+    """
     if args.feature[1] == "3":
         feat = "_tes"
     elif args.feature[1] == "5":
         feat = "_tss"
     else:
         feat = "tron"
-    new_df.to_csv(args.feature_file.replace(".tsv", "{}.tsv".format(feat)),
-                  index=False,
-                  sep="\t")
+    return args.feature_file.replace(".tsv", feat + EXTENSIONS[
+                                     args.intermediate_format or "tsv"])
 
-def Stats(args):
+def fingerprint_file(args):
     """
-    Sets argument types and runs stat functions for features.
+    Returns the name of the file where the contig fingerprints of an
+    incremental run are kept, next to its summary table. The tables of the
+    two intermediate formats are kept apart, so each has its own file.
     """
-    if not args.feature:
-        args.feature = args.feature_file[-6:-4]
-    print("Calculating {} feature statistics...".format(args.feature))
-    if args.feature == "r5" or args.feature == "l3":
-        args.strand = -1
+    return output_file(args) + ".contigs.json"
+
+def settings_key(args, limits):
+    """
+    Hashes the settings that every row of the summary table depends on.
+    """
+    return cache_key(args.feature,
+                     args.wobble,
+                     args.distance,
+                     args.cov_sample,
+                     args.check_surroundings,
+                     args.minimum,
+                     args.ratio,
+                     args.multiplier,
+                     hashlib.sha256(limits.tobytes()).hexdigest())
+
+def contig_fingerprints(args, ts_counts, non_ts_counts):
+    """
+    Hashes the ts and non-ts counts, the coverages and the reference
+    sequence of every contig of the feature file.
+    """
+    fingerprints = {}
+    for contig in ts_counts:
+        digest = hashlib.sha256()
+        for count_store in [ts_counts, non_ts_counts]:
+            for array in count_store.get(contig, ()):
+                digest.update(memoryview(array))
+            digest.update(b"|")
+        digest.update(args.coverage_store.fingerprint(contig).encode())
+        digest.update(b"|")
+        digest.update(args.reference_store.fingerprint(contig).encode())
+        fingerprints[contig] = digest.hexdigest()
+    return fingerprints
+
+def incremental_features(args, finish, limits):
+    """
+    Processes only the contigs whose counts, coverages or reference sequence
+    changed since the last incremental run with the same settings, and
+    splices them into the existing summary table. Returns the contigs whose
+    rows have changed, including the contigs that are gone, or None if the
+    earlier table could not be used.
+    """
+    with stage("read counts", feature=args.feature):
+        ts_counts = read_counts(args.feature_file)
+        non_ts_counts = read_counts(args.feature_file.replace("_ts", ""))
+    with stage("fingerprint", feature=args.feature):
+        fingerprints = contig_fingerprints(args, ts_counts, non_ts_counts)
+    settings = settings_key(args, limits)
+    previous = {}
+    if os.path.exists(output_file(args)):
+        try:
+            with open(fingerprint_file(args)) as ffile:
+                stored = json.load(ffile)
+            if stored["settings"] == settings:
+                previous = stored["contigs"]
+        except (OSError, ValueError, KeyError):
+            pass
+    changed = [contig for contig in fingerprints
+               if previous.get(contig) != fingerprints[contig]]
+    kept = [contig for contig in fingerprints if contig not in changed]
+    print("Reprocessing {} of {} contigs...".format(len(changed),
+                                                   len(fingerprints)))
+    kept_df = None
+    if kept:
+        kept_df = read_table(output_file(args),
+                             args.intermediate_format,
+                             contigs=kept)
+    tables = []
+    if changed:
+        tables = site_table(args, finish, contigs=changed,
+                            counts=(ts_counts, non_ts_counts))
+    # the fingerprints are only valid for the table that is written now
+    if os.path.exists(fingerprint_file(args)):
+        os.remove(fingerprint_file(args))
+    write_sites(args, tables, kept_df)
+    with open(fingerprint_file(args), "w") as ffile:
+        json.dump({"settings": settings, "contigs": fingerprints}, ffile)
+    if not previous:
+        return None
+    return changed + [contig for contig in previous
+                      if contig not in fingerprints]
+
+def find_features(args):
+    """
+    Processes the feature file on contigs and writes the summary table.
+    Returns the contigs whose rows have changed in an incremental run, and
+    None if the whole table was written.
+    """
+    limits = args.limits
+    if limits is None:
+        limits = limit_table(args.dictionary)
+    if args.incremental and not args.streaming:
+        return incremental_features(args, partial(classify, args=args,
+                                                  limits=limits), limits)
+    # the table of an incremental run is replaced, so its fingerprints are
+    # not valid anymore
+    if os.path.exists(fingerprint_file(args)):
+        os.remove(fingerprint_file(args))
+    if args.streaming:
+        stream_features(args, partial(classify, args=args, limits=limits))
+        return
+    write_sites(args, site_table(args, partial(classify, args=args,
+                                               limits=limits)))
+
+def pass_config(args, **changes):
+    """
+    Returns the immutable configuration of one pass from the arguments and
+    the given changes, with the strand and the signs of distance and
+    cov_sample set according to the feature.
+    """
+    options = dict(vars(args), **changes)
+    feature = options.get("feature") or options["feature_file"][-6:-4]
+    if feature == "r5" or feature == "l3":
+        strand = -1
     else:
-        args.strand = 1
-    if args.feature[1] == "3":
-        args.distance = abs(args.distance) * args.strand * (-1)
-        args.cov_sample = abs(args.cov_sample) * args.strand * (-1)
+        strand = 1
+    if feature[1] == "3":
+        sign = strand * (-1)
     else:
-        args.distance = abs(args.distance) * args.strand
-        args.cov_sample = abs(args.cov_sample) * args.strand
-    if os.stat(args.feature_file).st_size == 0:
+        sign = strand
+    options.update(feature=feature,
+                   strand=strand,
+                   distance=abs(options["distance"]) * sign,
+                   cov_sample=abs(options["cov_sample"]) * sign)
+    return PassConfig(**{field: options.get(field)
+                         for field in PassConfig._fields})
+
+def Stats(args, **changes):
+    """
+    Sets argument types and runs stat functions for features. The arguments
+    are not modified, so passes with different changes can run side by side.
+    Returns the changed contigs of an incremental pass, or None if every
+    contig may have changed.
+    """
+    config = pass_config(args, **changes)
+    print("Calculating {} feature statistics...".format(config.feature))
+    if os.stat(config.feature_file).st_size == 0:
         print("Feature file {} is empty. There is nothing to do here.".format(
-              args.feature_file))
+              config.feature_file))
     else:
-        find_features(args)
+        if config.coverage_store is None:
+            with stage("load coverage"):
+                config = config._replace(coverage_store=open_coverage(
+                        config.coverage_file, config.streaming))
+        if config.reference_store is None:
+            with stage("load reference"):
+                config = config._replace(reference_store=Reference(
+                        config.reference))
+        with stage("pass", feature=config.feature):
+            return find_features(config)
+    return None
 
 ###############################################################################
 ###                             Main function                               ###
@@ -285,7 +721,8 @@ def Stats(args):
 
 def main():
     args = parsing()
-    Stats(args)
+    with profiling(args.profile_report, args.profile_dump):
+        Stats(args)
 
 def parsing():
     parser = ArgumentParser(description="This is the deal_with_ts module of \
@@ -295,7 +732,9 @@ def parsing():
     parser.add_argument("coverage_file",
                         help="The tsv file which contains the coverages.\
                         The tsv file should contain 3 columns: contig, \
-                        position and coverage.",
+                        position and coverage. An indexed bam file can also \
+                        be given, in which case the coverages are read from \
+                        it around the feature positions only.",
                         metavar="coverage_file")
     parser.add_argument("feature_file",
                         help="A tab-separated values file containing feature\
@@ -390,6 +829,59 @@ def parsing():
                         default=(str(os.path.abspath(__file__)).replace(
                                 "deal_with_ts.py","")) + "dict.tsv",
                         metavar="[string]")
+    parser.add_argument("-p", "--threads",
+                        dest="threads",
+                        help="The number of processes that the contigs are \
+                        distributed between. The default value is 1.",
+                        type=int,
+                        default=1,
+                        metavar="[integer]")
+    parser.add_argument("--cache_dir",
+                        dest="cache_dir",
+                        help="A directory where the processed tables of the \
+                        contigs are cached. Reruns with the same inputs and \
+                        settings, apart from the thresholds of the \
+                        classification, reuse them. By default nothing is \
+                        cached.",
+                        default=None,
+                        metavar="[directory]")
+    parser.add_argument("--cache_size",
+                        dest="cache_size",
+                        help="The size limit of the cache directory in MB. \
+                        The least recently used tables are removed above it.\
+                        The default value is 10240.",
+                        type=int,
+                        default=10240,
+                        metavar="[integer]")
+    parser.add_argument("--streaming",
+                        dest="streaming",
+                        help="Process the contigs one at a time, reading only \
+                        the lines of the current contig from the feature, \
+                        count and coverage files, and append the results to \
+                        the output. This keeps the memory use bounded by the \
+                        largest contig. The input files have to be sorted by \
+                        contig. The cache directory is not used.",
+                        action="store_true")
+    parser.add_argument("--incremental",
+                        dest="incremental",
+                        help="Keep a fingerprint of the counts, coverages \
+                        and reference sequence of every contig next to the \
+                        summary table, and on later runs with the same \
+                        settings only process the contigs whose \
+                        fingerprints have changed. Their rows are spliced \
+                        into the existing summary table. This is not used \
+                        with --streaming.",
+                        action="store_true")
+    parser.add_argument("--intermediate_format",
+                        dest="intermediate_format",
+                        help="The format of the summary tables, 'tsv' or \
+                        'parquet'. Parquet tables have one row group per \
+                        contig, and only the columns that are needed for the \
+                        gff files are read from them. This requires the \
+                        pyarrow package. The default is 'tsv'.",
+                        choices=["tsv", "parquet"],
+                        default="tsv",
+                        metavar="[tsv|parquet]")
     parser.add_argument("-g", "--check_surroundings",
                         dest="check_surroundings",
                         help="The number of nucleotides surrounding the \
@@ -398,9 +890,23 @@ def parsing():
                         type=int,
                         default=10,
                         metavar="[integer]")
-    if not parser.parse_args().feature:
-        parser.parse_args().feature = parser.parse_args().feature_file[-6:-4]
-    return parser.parse_args()
+    parser.add_argument("--profile_report", "--profile-report",
+                        dest="profile_report",
+                        help="Write the wall time, CPU time, peak memory and \
+                        number of rows of each stage and contig to this json \
+                        file.",
+                        default=None,
+                        metavar="[file]")
+    parser.add_argument("--profile_dump", "--profile-dump",
+                        dest="profile_dump",
+                        help="Profile the functions of the main process with \
+                        cProfile and save the statistics to this file.",
+                        default=None,
+                        metavar="[file]")
+    args = parser.parse_args()
+    if not args.feature:
+        args.feature = args.feature_file[-6:-4]
+    return args
     
 if __name__== "__main__":
     main()
\ No newline at end of file
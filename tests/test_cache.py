@@ -0,0 +1,20 @@
+import os
+
+import numpy as np
+
+from ts_cache import SiteCache
+
+def test_evict_removes_least_recently_used(tmp_path):
+    table = np.zeros(1000, dtype=np.int64)
+    cache = SiteCache(str(tmp_path), 0)
+    for number, key in enumerate(["a", "b", "c", "d"]):
+        cache.put(key, table)
+        os.utime(cache.path(key), ns=(number * 10 ** 9, number * 10 ** 9))
+    size = os.path.getsize(cache.path("a"))
+    # saving does not evict, the tables are only trimmed by evict
+    assert sorted(os.listdir(str(tmp_path))) == ["a.pkl", "b.pkl", "c.pkl",
+                                                 "d.pkl"]
+    assert cache.get("a") is not None
+    cache.max_bytes = 2 * size
+    cache.evict()
+    assert sorted(os.listdir(str(tmp_path))) == ["a.pkl", "d.pkl"]
@@ -0,0 +1,132 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+from ts_coverage import BamCoverage, CoverageStore
+from ts_pool import map_forked, shared, sharing
+
+pysam = pytest.importorskip("pysam")
+
+LENGTHS = {"chr1": 400, "chr2": 150, "empty": 80}
+
+def write_bam(path, seed=7):
+    """
+    Writes a sorted and indexed bam file of random reads and returns the
+    1-based depth of every contig. Deletions do not count as coverage.
+    """
+    rng = random.Random(seed)
+    header = {"HD": {"VN": "1.6", "SO": "unsorted"},
+              "SQ": [{"SN": contig, "LN": length}
+                     for contig, length in LENGTHS.items()]}
+    depths = {contig: np.zeros(length + 1, dtype=np.int64)
+              for contig, length in LENGTHS.items()}
+    unsorted = path + ".unsorted.bam"
+    with pysam.AlignmentFile(unsorted, "wb", header=header) as bam:
+        for number in range(300):
+            contig = rng.choice(["chr1", "chr2"])
+            start = rng.randrange(LENGTHS[contig] - 20)
+            cigar = [(0, rng.randint(5, 15))]
+            if rng.random() < 0.3:
+                cigar += [(2, rng.randint(1, 4)), (0, rng.randint(3, 8))]
+            reference_end = start + sum(length for _, length in cigar)
+            if reference_end > LENGTHS[contig]:
+                cigar = [(0, LENGTHS[contig] - start)]
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = "read{}".format(number)
+            read.reference_name = contig
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.cigartuples = cigar
+            read.query_sequence = "".join(
+                rng.choice("ACGT") for _ in range(
+                    sum(length for op, length in cigar if op == 0)))
+            read.query_qualities = pysam.qualitystring_to_array(
+                "I" * len(read.query_sequence))
+            read.is_reverse = rng.random() < 0.5
+            bam.write(read)
+            position = start + 1
+            for op, length in cigar:
+                if op == 0:
+                    depths[contig][position:position + length] += 1
+                position += length
+    pysam.sort("-o", path, unsorted)
+    pysam.index(path)
+    os.remove(unsorted)
+    return depths
+
+def write_allcov(path, depths):
+    """
+    Writes the contig, position, coverage tsv of the depths, with every
+    position of the contigs like samtools depth -a.
+    """
+    with open(path, "w") as cfile:
+        for contig, depth in depths.items():
+            for position in range(1, len(depth)):
+                cfile.write("{}\t{}\t{}\n".format(contig, position,
+                                                  depth[position]))
+
+def windows(length, seed):
+    """
+    Returns random windows that overlap each other, including windows that
+    reach past either end of the contig, and some that are nested in or
+    equal to others.
+    """
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(-30, length + 30, size=60)
+    ends = starts + rng.integers(0, 40, size=60)
+    starts = np.concatenate((starts, starts[:5] + 2, starts[5:10],
+                             [-10, 0, 1, length, length + 1, -50]))
+    ends = np.concatenate((ends, ends[:5] - 2, ends[5:10],
+                           [5, 1, length + 1, length + 20, length + 9, -20]))
+    return starts, np.maximum(ends, starts)
+
+@pytest.fixture(scope="module")
+def coverages(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("coverage")
+    bam_file = str(directory / "reads.bam")
+    tsv_file = str(directory / "reads_allcov.tsv")
+    write_allcov(tsv_file, write_bam(bam_file))
+    return BamCoverage(bam_file), CoverageStore.from_tsv(tsv_file)
+
+@pytest.mark.parametrize("contig", ["chr1", "chr2", "empty", "missing"])
+def test_bam_window_sums_match_tsv(coverages, contig):
+    bam, store = coverages
+    starts, ends = windows(LENGTHS.get(contig, 50), seed=len(contig))
+    assert np.array_equal(bam.window_sums(contig, starts, ends),
+                          store.window_sums(contig, starts, ends))
+
+def test_bam_merges_overlapping_windows(coverages, monkeypatch):
+    bam, store = coverages
+    regions = []
+    depth = bam.depth
+    monkeypatch.setattr(bam, "depth", lambda contig, start, end: (
+        regions.append((start, end)) or depth(contig, start, end)))
+    starts = np.array([50, 10, 20, 60, 100, 95, 40])
+    ends = np.array([70, 30, 40, 65, 100, 101, 45])
+    sums = bam.window_sums("chr1", starts, ends)
+    # windows that only touch are read as separate regions
+    assert regions == [(10, 40), (40, 45), (50, 70), (95, 101)]
+    assert np.array_equal(sums, store.window_sums("chr1", starts, ends))
+
+def forked_sums(contig):
+    """
+    Sums the windows of a contig with the bam coverage of the parent.
+    """
+    bam = shared["bam"]
+    starts, ends = windows(LENGTHS[contig], seed=3)
+    sums = bam.window_sums(contig, starts, ends)
+    return os.getpid(), bam.pid, sums
+
+def test_bam_reopens_in_forked_worker(coverages):
+    bam, store = coverages
+    bam.window_sums("chr1", [1], [10])
+    with sharing(bam=bam):
+        results = map_forked(forked_sums, ["chr1", "chr2"], 2)
+    for contig, (pid, bam_pid, sums) in zip(["chr1", "chr2"], results):
+        assert pid != os.getpid()
+        assert bam_pid == pid
+        starts, ends = windows(LENGTHS[contig], seed=3)
+        assert np.array_equal(sums, store.window_sums(contig, starts, ends))
+    assert bam.pid == os.getpid()
@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import ts_bench
+import ts_launcher
+from ts_daemon import FilterServer, request
+
+@pytest.fixture
+def server():
+    # port 0 binds the server to a free port
+    server = FilterServer(0, 2, 4, 4)
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+    yield server
+    request(server.server_address[1], "POST", "/shutdown", {})
+    thread.join(timeout=60)
+    assert not thread.is_alive()
+
+def post_jobs(port, body):
+    """
+    Posts a raw body to /jobs and returns the status code and the answer.
+    """
+    req = urllib.request.Request("http://127.0.0.1:{}/jobs".format(port),
+                                 data=body,
+                                 method="POST")
+    try:
+        with urllib.request.urlopen(req) as answer:
+            return answer.status, json.loads(answer.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+def wait(port, job, seconds=120):
+    """
+    Polls a job until it is finished and returns its final state.
+    """
+    deadline = time.time() + seconds
+    while job["status"] in ["queued", "running"]:
+        assert time.time() < deadline, "the job did not finish"
+        time.sleep(0.1)
+        job = request(port, "GET", "/jobs/{}".format(job["id"]))
+    return job
+
+def test_job_matches_launcher(server, tmp_path):
+    port = server.server_address[1]
+    outputs = {}
+    for name in ["launcher", "server"]:
+        (tmp_path / name).mkdir()
+        prefix = str(tmp_path / name / "sample")
+        ts_bench.generate(prefix, 300, 3, seed=5)
+        args = ts_bench.launcher_args(prefix, 1)
+        if name == "launcher":
+            ts_launcher.launch(args)
+        else:
+            code, job = post_jobs(port, json.dumps(
+                [prefix, "-r", prefix + "_reference.fasta"]).encode())
+            assert code == 202
+            assert wait(port, job)["status"] == "done"
+        outputs[name] = []
+        for path in ts_bench.output_files(args):
+            with open(path, "rb") as ofile:
+                outputs[name].append(ofile.read())
+    assert all(outputs["launcher"])
+    assert outputs["server"] == outputs["launcher"]
+
+@pytest.mark.parametrize("body", [["prefix", "--no_such_option"],
+                                  ["prefix", "-p", "many"],
+                                  [],
+                                  {"prefix": "sample"},
+                                  "not json"])
+def test_bad_arguments_are_rejected(server, body):
+    port = server.server_address[1]
+    data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+    code, answer = post_jobs(port, data)
+    assert code == 400
+    assert "error" in answer
+    assert request(port, "GET", "/status")["jobs"] == 0
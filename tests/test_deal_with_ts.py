@@ -0,0 +1,215 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from deal_with_ts import (check_if_greatest, count_As, count_average,
+                          coverage, get_As, pick_from_greatests)
+from ts_coverage import CoverageStore, dense_array
+from ts_reference import Reference
+from ts_track import build_track
+
+# The 20 nucleotides upstream of a polyA site in the order in which they are
+# counted, and their A counts, from the examples of the README
+README_WINDOWS = [("AAAACAAGAACGTACTGAGT", 6),
+                  ("AAAGTACTAAAGAATACATG", 4),
+                  ("AACCTGAAAATCTACGCACA", 2)]
+
+COMPLEMENT = str.maketrans("ACGTacgt", "TGCAtgca")
+
+###############################################################################
+###          The original implementations, which the kernels replace       ###
+###############################################################################
+
+def original_get_As(seq_record, position, args):
+    if args.strand < 0:
+        c = 1
+        d = 19
+    else:
+        c = 20
+        d = 0
+    seq = seq_record.seq[position - c:position + d].lower()
+    if args.strand < 0:
+        seq = seq.reverse_complement()
+    countAs = 0
+    count_list = []
+    for char in seq[::-1]:
+        if char == "a":
+            countAs += 1
+            count_list.append(countAs)
+        else:
+            countAs += -1
+            count_list.append(countAs)
+        if countAs < 0:
+            break
+    countAs = max(count_list)
+    if countAs < 0:
+        countAs = 0
+    return countAs
+
+def original_coverage(pos_list, args, cov_dict):
+    coverages = []
+    for pos in pos_list:
+        to_avg = []
+        if args.distance > args.cov_sample:
+            for position in range(pos + args.distance - args.cov_sample,
+                                  pos + args.distance):
+                to_avg.append(cov_dict.get(position, 0))
+        elif args.distance < args.cov_sample:
+            for position in range(pos + args.distance,
+                                  pos + args.distance - args.cov_sample):
+                to_avg.append(cov_dict.get(position, 0))
+        else:
+            to_avg.append(cov_dict.get(pos + args.distance, 0))
+        coverages.append(sum(to_avg)/len(to_avg))
+    return coverages
+
+def original_check_if_greatest(tuples, wobble):
+    is_greatest_list = []
+    for tup in tuples:
+        pos, count = tup
+        for position, count2 in tuples:
+            is_greatest = True
+            if position in range(pos - wobble, pos + wobble + 1):
+                is_greatest = count >= count2
+                if not is_greatest:
+                    break
+        is_greatest_list.append(is_greatest)
+    return is_greatest_list
+
+def original_pick_from_greatests(dictionary, wobble):
+    previous = -100
+    is_picked_list = []
+    for pos, is_greatest in dictionary.items():
+        is_picked = False
+        if is_greatest:
+            if previous not in range(pos - wobble, pos + wobble + 1):
+                is_picked = True
+            previous = pos
+        is_picked_list.append(is_picked)
+    return is_picked_list
+
+def original_count_average(tuples, window):
+    in_window = []
+    for tup in tuples:
+        pos, count = tup
+        hundred = 0
+        for position, count2 in tuples:
+            if position in range(pos - window, pos + window + 1):
+                hundred += count2
+        in_window.append(hundred/(2 * window + 1))
+    return in_window
+
+###############################################################################
+###                                A counts                                 ###
+###############################################################################
+
+def write_fasta(path, sequences, width=60):
+    with open(path, "w") as ffile:
+        for contig, sequence in sequences.items():
+            ffile.write(">{}\n".format(contig))
+            for start in range(0, len(sequence), width):
+                ffile.write(sequence[start:start + width] + "\n")
+
+def test_count_As_of_readme_windows():
+    codes = np.array([np.frombuffer(window.encode(), dtype=np.uint8)
+                      for window, count in README_WINDOWS])
+    assert count_As(codes, 1).tolist() == [6, 4, 2]
+    # on the reverse strand the complementary bases are read
+    complement = np.array([np.frombuffer(window.translate(COMPLEMENT)
+                                         .encode(), dtype=np.uint8)
+                           for window, count in README_WINDOWS])
+    assert count_As(complement, -1).tolist() == [6, 4, 2]
+
+@pytest.mark.parametrize("track", [False, True])
+def test_get_As_of_readme_windows_on_both_strands(tmp_path, track):
+    # the forward strand is read leftwards from the base before the site and
+    # the reverse strand rightwards, on the complementary strand
+    windows = [window for window, count in README_WINDOWS]
+    sequences = {"forward": "".join("G" + window[::-1] + "G"
+                                    for window in windows),
+                 "reverse": "".join("C" + window.translate(COMPLEMENT) + "C"
+                                    for window in windows),
+                 "edges": "GAAAACGCGCGCGCTTT"}
+    fasta = str(tmp_path / "reference.fasta")
+    write_fasta(fasta, sequences, width=7)
+    if track:
+        build_track(fasta)
+    reference = Reference(fasta)
+    assert (reference.track is not None) == track
+    forward = np.array([22 * number + 21 for number in range(3)])
+    reverse = np.array([22 * number + 2 for number in range(3)])
+    assert get_As(reference, "forward", forward,
+                  SimpleNamespace(strand=1)).tolist() == [6, 4, 2]
+    assert get_As(reference, "reverse", reverse,
+                  SimpleNamespace(strand=-1)).tolist() == [6, 4, 2]
+    # the counting stops at the ends of the contig
+    assert get_As(reference, "edges", np.array([5, 1]),
+                  SimpleNamespace(strand=1)).tolist() == [4, 0]
+    assert get_As(reference, "edges", np.array([15, 17]),
+                  SimpleNamespace(strand=-1)).tolist() == [3, 1]
+
+@pytest.mark.parametrize("track", [False, True])
+def test_get_As_matches_original(tmp_path, track):
+    SeqIO = pytest.importorskip("Bio.SeqIO")
+    rng = np.random.default_rng(9)
+    sequences = {}
+    for number, length in enumerate([1500, 333, 45]):
+        # A- and T-rich sequences with lower case bases and other letters
+        bases = rng.choice(list("AAAATTTTCGacgtnNRU"), length)
+        sequences["contig_{}".format(number)] = "".join(bases)
+    fasta = str(tmp_path / "reference.fasta")
+    write_fasta(fasta, sequences)
+    if track:
+        build_track(fasta)
+    reference = Reference(fasta)
+    for record in SeqIO.parse(fasta, "fasta"):
+        length = len(record.seq)
+        for strand, first in [(1, 20), (-1, 1)]:
+            # the original slicing is only defined from these positions on
+            positions = np.arange(first, length + 1)
+            args = SimpleNamespace(strand=strand)
+            expected = [original_get_As(record, int(position), args)
+                        for position in positions]
+            assert get_As(reference, record.id, positions,
+                          args).tolist() == expected
+
+###############################################################################
+###                         Coverages and windows                           ###
+###############################################################################
+
+@pytest.mark.parametrize("distance, cov_sample",
+                         [(15, 10), (-15, -10), (4, 4), (-4, -4), (10, 9)])
+def test_coverage_matches_original(distance, cov_sample):
+    rng = np.random.default_rng(abs(distance) * 100 + abs(cov_sample))
+    # a sparse coverage, positions without coverage are missing
+    covered = np.unique(rng.integers(1, 400, 250))
+    depths = rng.integers(0, 50, len(covered))
+    store = CoverageStore({"contig": dense_array(covered, depths)})
+    args = SimpleNamespace(distance=distance, cov_sample=cov_sample,
+                           coverage_store=store)
+    positions = np.concatenate((rng.integers(1, 400, 200),
+                                [1, 2, 399, 400, 420]))
+    expected = original_coverage(positions.tolist(), args,
+                                 dict(zip(covered.tolist(), depths.tolist())))
+    assert coverage(positions, args, "contig").tolist() == expected
+
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("wobble", [0, 3, 10])
+def test_windows_match_original(descending, wobble):
+    rng = np.random.default_rng(wobble + descending)
+    positions = np.sort(rng.choice(np.arange(1, 600), 300, replace=False))
+    counts = rng.integers(1, 6, len(positions))
+    if descending:
+        # the positions of right features are processed from right to left
+        positions = positions[::-1]
+        counts = counts[::-1]
+    tuples = list(zip(positions.tolist(), counts.tolist()))
+    is_greatest = check_if_greatest(positions, counts, wobble)
+    assert is_greatest.tolist() == original_check_if_greatest(tuples, wobble)
+    assert pick_from_greatests(positions, is_greatest, wobble).tolist() == (
+        original_pick_from_greatests(dict(zip(positions.tolist(),
+                                              is_greatest.tolist())),
+                                     wobble))
+    assert count_average(positions, counts, 50).tolist() == (
+        original_count_average(tuples, 50))
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ts_gff import chunk_bounds, cluster
+
+def baseline_picks(lines, wobble, leftmost):
+    """
+    Picks the lines of one contig and strand like the clustering of the
+    original ts_gff and returns their ids.
+    """
+    lines = lines.sort_values(by="start")
+    start = lines["start"].to_numpy()
+    previous = np.concatenate(([-999], start[:-1]))
+    ids = np.cumsum(np.abs(start - previous) > wobble)
+    is_greatest = lines["score"] == lines.groupby(ids)["score"].transform(
+        "max")
+    greatest_start = lines["start"].where(is_greatest)
+    extreme = greatest_start.groupby(ids).transform(
+        "min" if leftmost else "max")
+    return set(lines.loc[is_greatest & (lines["start"] == extreme), "id"])
+
+def random_lines(seed):
+    rng = np.random.default_rng(seed)
+    size = 2000
+    return pd.DataFrame({"id": np.arange(size),
+                         "contig": rng.choice(["c1", "c2", "c3", "c10"],
+                                              size),
+                         "strand": rng.choice(["+", "-"], size),
+                         "start": rng.integers(1, 3000, size),
+                         "score": rng.integers(1, 5, size)})
+
+@pytest.mark.parametrize("feature", ["tes", "tss"])
+@pytest.mark.parametrize("chunks", [1, 3, 16])
+def test_cluster_matches_baseline_per_partition(feature, chunks):
+    lines = random_lines(seed=chunks)
+    wobble = 10
+    expected = set()
+    for (contig, strand), partition in lines.groupby(["contig", "strand"]):
+        leftmost = ((strand == "-" and feature == "tes")
+                    or (strand == "+" and feature == "tss"))
+        expected |= baseline_picks(partition, wobble, leftmost)
+    lines = lines.sort_values(by=["contig", "strand", "start"], kind="stable")
+    contig = lines["contig"].to_numpy()
+    strand = lines["strand"].to_numpy()
+    is_new = np.ones(len(lines), dtype=bool)
+    is_new[1:] = (contig[1:] != contig[:-1]) | (strand[1:] != strand[:-1])
+    leftmost = (((strand == "-") & (feature == "tes"))
+                | ((strand == "+") & (feature == "tss")))
+    start = lines["start"].to_numpy()
+    score = lines["score"].to_numpy()
+    bounds = chunk_bounds(is_new, chunks)
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(lines)
+    assert all(is_new[first] for first, last in bounds)
+    mask = np.concatenate([cluster(start[first:last], score[first:last],
+                                   wobble, leftmost[first:last],
+                                   is_new[first:last])
+                           for first, last in bounds])
+    assert set(lines.loc[mask, "id"]) == expected
+
+def test_cluster_of_no_lines():
+    empty = np.zeros(0, dtype=np.int64)
+    assert len(cluster(empty, empty, 10, empty.astype(bool),
+                       empty.astype(bool))) == 0
+    assert chunk_bounds(np.zeros(0, dtype=bool), 4) == []
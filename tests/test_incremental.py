@@ -0,0 +1,46 @@
+import ts_bench
+import ts_launcher
+
+def run(prefix, *options):
+    """
+    Runs the launcher with the default arguments and the given options.
+    """
+    args = ts_bench.launcher_args(prefix, 1)
+    for option in options:
+        setattr(args, option[0], option[1])
+    ts_launcher.launch(args)
+    return args
+
+def change_counts(count_file, contig):
+    """
+    Triples the counts of a contig in a count file.
+    """
+    with open(count_file) as cfile:
+        lines = cfile.read().splitlines()
+    with open(count_file, "w") as cfile:
+        for line in lines:
+            site, count = line.rsplit("\t", 1)
+            if "'{}'".format(contig) in site:
+                count = str(int(count) * 3)
+            cfile.write("{}\t{}\n".format(site, count))
+
+def read_outputs(args):
+    outputs = []
+    for path in ts_bench.output_files(args):
+        with open(path, "rb") as ofile:
+            outputs.append(sorted(ofile.read().splitlines()))
+    return outputs
+
+def test_formats_keep_their_own_fingerprints(tmp_path):
+    prefix = str(tmp_path / "sample")
+    ts_bench.generate(prefix, 300, 3, seed=11)
+    run(prefix, ("incremental", True))
+    change_counts(prefix + "_ts_l3.tsv", "contig_2")
+    run(prefix, ("incremental", True), ("intermediate_format", "parquet"))
+    # the tsv table is older than the changed counts, although the parquet
+    # table is not
+    args = run(prefix, ("incremental", True))
+    fresh = str(tmp_path / "fresh")
+    ts_bench.generate(fresh, 300, 3, seed=11)
+    change_counts(fresh + "_ts_l3.tsv", "contig_2")
+    assert read_outputs(args) == read_outputs(run(fresh))
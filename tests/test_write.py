@@ -0,0 +1,26 @@
+import deal_with_ts
+import ts_bench
+import ts_launcher
+
+def outputs(directory, write_rows, monkeypatch):
+    """
+    Runs the launcher on a synthetic sample, writing the summary tables in
+    batches of the given number of rows, and returns its outputs.
+    """
+    directory.mkdir()
+    prefix = str(directory / "sample")
+    ts_bench.generate(prefix, 400, 20, seed=3)
+    monkeypatch.setattr(deal_with_ts, "WRITE_ROWS", write_rows)
+    args = ts_bench.launcher_args(prefix, 1)
+    ts_launcher.launch(args)
+    contents = []
+    for path in ts_bench.output_files(args):
+        with open(path, "rb") as ofile:
+            contents.append(ofile.read())
+    return contents
+
+def test_batched_tables_match_contig_tables(tmp_path, monkeypatch):
+    # a single row writes every contig on its own
+    single = outputs(tmp_path / "single", 1, monkeypatch)
+    assert single == outputs(tmp_path / "batched", 50, monkeypatch)
+    assert single == outputs(tmp_path / "whole", 10 ** 9, monkeypatch)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import os
+from argparse import ArgumentParser, Namespace
+from multiprocessing.connection import wait
+import deal_with_ts
+import ts_launcher
+from ts_reference import Reference
+
+# A rough ratio of the memory used by a sample to the size of its input files
+MEMORY_FACTOR = 3
+
+def read_manifest(manifest):
+    """
+    Reads the LoRTIA prefixes of a manifest file, one per line. Empty lines
+    and lines starting with # are skipped.
+    """
+    prefixes = []
+    with open(manifest) as mfile:
+        for line in mfile:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                prefixes.append(line)
+    return prefixes
+
+def estimate_memory(prefix, coverage_source):
+    """
+    Estimates the memory needed by a sample in MB from the size of its input
+    files. Binary coverage caches and bam files are read without loading
+    them, so they are not counted.
+    """
+    files = [prefix + "_ts_l3.tsv",
+             prefix + "_ts_r3.tsv",
+             prefix + "_l3.tsv",
+             prefix + "_r3.tsv"]
+    coverage_file = prefix + "_out_allcov.tsv"
+    if (coverage_source == "tsv"
+            and not os.path.exists(os.path.splitext(coverage_file)[0]
+                                   + ".covbin")):
+        files.append(coverage_file)
+    size = sum(os.path.getsize(path) for path in files
+               if os.path.exists(path))
+    return size * MEMORY_FACTOR / 1024 ** 2
+
+def sample_args(args, prefix):
+    """
+    Returns the arguments of the single-sample launcher for one prefix.
+    """
+    options = vars(args).copy()
+    del options["manifest"], options["jobs"], options["memory"]
+    options["prefix"] = prefix
+    return Namespace(**options)
+
+def batch(args):
+    """
+    Runs the launcher on every prefix of the manifest on forked processes.
+    A sample is only started if the estimated memory of the running samples
+    stays within the budget, but at least one sample is always running.
+    Failed samples are reported at the end instead of stopping the batch.
+    """
+    prefixes = read_manifest(args.manifest)
+    # the limit table and, if the samples are forked, the reference index
+    # are shared by all samples
+    args.limits = deal_with_ts.limit_table(args.dictionary)
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        args.reference_store = Reference(args.reference)
+    else:
+        context = multiprocessing.get_context()
+    pending = [(prefix, estimate_memory(prefix, args.coverage_source))
+               for prefix in prefixes]
+    running = {}
+    failed = []
+    while pending or running:
+        used = sum(memory for process, (prefix, memory) in running.values())
+        while (pending and len(running) < args.jobs
+               and (not running or used + pending[0][1] <= args.memory)):
+            prefix, memory = pending.pop(0)
+            print("Starting sample {}...".format(prefix))
+            process = context.Process(target=ts_launcher.launch,
+                                      args=(sample_args(args, prefix),))
+            process.start()
+            running[process.sentinel] = (process, (prefix, memory))
+            used += memory
+        for sentinel in wait(list(running)):
+            process, (prefix, memory) = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                failed.append(prefix)
+                print("Sample {} failed with exit code {}.".format(
+                      prefix, process.exitcode))
+            else:
+                print("Sample {} is done.".format(prefix))
+    print("{} of {} samples finished successfully.".format(
+          len(prefixes) - len(failed), len(prefixes)))
+    for prefix in failed:
+        print("Failed: {}".format(prefix))
+    return failed
+
+###############################################################################
+###                             Main function                               ###
+###############################################################################
+
+def main():
+    args = parsing()
+    if batch(args):
+        raise SystemExit(1)
+
+def parsing():
+    parser = ArgumentParser(description="This module runs the \
+                            template-switching filter on many LoRTIA outputs\
+                            that were mapped to the same reference. The \
+                            reference index and the limit table are loaded \
+                            only once.")
+    parser.add_argument("manifest",
+                        help="A file with the path and the prefix of the \
+                        LoRTIA outputs of one sample in each line.",
+                        metavar="manifest")
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs",
+                        help="The number of samples that are processed at \
+                        the same time. The default value is 1.",
+                        type=int,
+                        default=1,
+                        metavar="[integer]")
+    parser.add_argument("--memory",
+                        dest="memory",
+                        help="The memory budget of the running samples in \
+                        MB. The memory of a sample is estimated from the size\
+                        of its input files. The default value is 16384.",
+                        type=float,
+                        default=16384,
+                        metavar="[float]")
+    ts_launcher.add_options(parser)
+    return parser.parse_args()
+
+
+if __name__== "__main__":
+    main()
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+import deal_with_ts
+import ts_gff
+import ts_launcher
+from ts_coverage import open_coverage
+from ts_reference import Reference
+from ts_sites import SiteTable
+
+STAGES = ["load",
+          "read",
+          "coverage",
+          "greatest",
+          "get10",
+          "A-count",
+          "classification",
+          "gff"]
+
+# The command line tools whose start-up is timed, and the libraries that
+# they should only load once a stage needs them
+ENTRY_POINTS = ["ts_launcher.py",
+                "deal_with_ts.py",
+                "ts_gff.py",
+                "ts_sweep.py",
+                "ts_batch.py",
+                "ts_daemon.py",
+                "ts_track.py",
+                "ts_coverage.py"]
+HEAVY_MODULES = ["numpy", "pandas", "pyarrow", "pysam"]
+
+###############################################################################
+###                        Synthetic LoRTIA outputs                         ###
+###############################################################################
+
+def random_sequence(rng, length):
+    """
+    Returns a random sequence as uint8 character codes with A and T
+    stretches, the latter being polyA stretches of the reverse strand, and
+    the start and end positions of the stretches.
+    """
+    codes = rng.choice(np.frombuffer(b"ACGT", dtype=np.uint8), length)
+    number = max(length // 100, 1)
+    starts = np.sort(rng.integers(0, length - 20, number))
+    ends = starts + rng.integers(4, 16, number)
+    bases = rng.choice(np.frombuffer(b"AT", dtype=np.uint8), number)
+    for start, end, base in zip(starts, ends, bases):
+        codes[start:end] = base
+    return codes, starts, ends, bases
+
+def write_fasta(fasta, sequences):
+    with open(fasta, "w") as ffile:
+        for contig, codes in sequences.items():
+            ffile.write(">{} synthetic\n".format(contig))
+            text = codes.tobytes().decode()
+            for start in range(0, len(text), 60):
+                ffile.write(text[start:start + 60] + "\n")
+
+def write_coverage(coverage_file, rng, lengths):
+    """
+    Writes a random walk of coverages for every contig, leaving out the
+    positions with 0 coverage like LoRTIA does.
+    """
+    with open(coverage_file, "w") as cfile:
+        for contig, length in lengths.items():
+            depth = np.abs(np.cumsum(rng.integers(-3, 4, length))) + 20
+            depth[rng.random(length) < 0.01] = 0
+            positions = np.arange(1, length + 1)
+            covered = depth > 0
+            pd.DataFrame({"contig": contig,
+                          "pos": positions[covered],
+                          "count": depth[covered]}).to_csv(
+                cfile, sep="\t", header=False, index=False)
+
+def site_counts(rng, number):
+    """
+    Returns read counts with a long tail, as most sites are supported by one
+    or two reads.
+    """
+    counts = rng.geometric(0.4, number)
+    counts[rng.random(number) < 0.02] *= 20
+    return counts
+
+def write_counts(count_file, sites):
+    """
+    Writes ('contig', position)<tab>count lines, sorted by contig.
+    """
+    with open(count_file, "w") as cfile:
+        for contig, (positions, counts) in sites.items():
+            cfile.writelines("('{}', {})\t{}\n".format(contig, pos, count)
+                             for pos, count in zip(positions, counts))
+
+def place_sites(rng, number, length, anchors):
+    """
+    Places unique positions on a contig, half of them next to the anchors
+    and the rest randomly, and shuffles them like the unsorted LoRTIA
+    output.
+    """
+    near = anchors[rng.integers(0, len(anchors), number // 2)]
+    near = near + rng.integers(-3, 4, len(near))
+    anywhere = rng.integers(30, length - 30, number - len(near))
+    positions = np.unique(np.clip(np.concatenate([near, anywhere]),
+                                  30, length - 30))
+    rng.shuffle(positions)
+    return positions
+
+def generate(prefix, sites, contigs, seed):
+    """
+    Writes a synthetic reference and LoRTIA outputs with about `sites`
+    positions in every count file: the prefix_reference.fasta, the
+    prefix_out_allcov.tsv, the prefix_ts_l3.tsv and prefix_ts_r3.tsv files,
+    their non-ts counterparts and the prefix_tes.gff3. Half of the ts
+    positions are placed next to A or T stretches, where template switching
+    is expected.
+    """
+    rng = np.random.default_rng(seed)
+    length = max(sites * 20 // contigs, 1000)
+    sequences = {}
+    anchors = {"r3": {}, "l3": {}}
+    for number in range(contigs):
+        contig = "contig_{}".format(number + 1)
+        codes, starts, ends, bases = random_sequence(rng, length)
+        sequences[contig] = codes
+        # a polyA stretch follows the 3' end on the forward strand and a
+        # polyT stretch precedes it on the reverse strand
+        forward = starts[bases == ord("A")]
+        reverse = ends[bases == ord("T")] + 1
+        anchors["r3"][contig] = forward if len(forward) else starts
+        anchors["l3"][contig] = reverse if len(reverse) else ends
+    write_fasta(prefix + "_reference.fasta", sequences)
+    write_coverage(prefix + "_out_allcov.tsv", rng,
+                   {contig: len(codes) for contig, codes in sequences.items()})
+    per_contig = max(sites // contigs, 1)
+    gff = []
+    for feature in ["l3", "r3"]:
+        ts_sites = {}
+        non_ts_sites = {}
+        for contig in sequences:
+            positions = place_sites(rng, per_contig, length,
+                                    anchors[feature][contig])
+            ts_sites[contig] = (positions, site_counts(rng, len(positions)))
+            # the real ends overlap partly with the ts positions
+            positions = place_sites(rng, per_contig, length, positions)
+            non_ts_sites[contig] = (positions,
+                                    site_counts(rng, len(positions)))
+            picked = positions[:max(len(positions) // 8, 1)]
+            gff.append(pd.DataFrame({"contig": contig,
+                                     "source": "LoRTIA",
+                                     "feature": "tes",
+                                     "start": picked,
+                                     "end": picked,
+                                     "score": site_counts(rng, len(picked)),
+                                     "strand": "+" if feature == "r3"
+                                               else "-",
+                                     "frame": ".",
+                                     "info": site_counts(rng, len(picked))},
+                                    columns=ts_gff.GFF_COLUMNS))
+        write_counts("{}_ts_{}.tsv".format(prefix, feature), ts_sites)
+        write_counts("{}_{}.tsv".format(prefix, feature), non_ts_sites)
+    pd.concat(gff).to_csv(prefix + "_tes.gff3", sep="\t", header=False,
+                          index=False)
+
+###############################################################################
+###                               Benchmarks                                ###
+###############################################################################
+
+def peak_memory():
+    """
+    Returns the peak resident memory of the process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024 ** 2
+    return peak / 1024
+
+def timed(report, stage, function, *args):
+    """
+    Runs a function and adds its time to the stage in the report. The peak
+    memory of the process after the stage is also recorded.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    report["seconds"][stage] += time.perf_counter() - start
+    report["peak_mb"][stage] = max(report["peak_mb"][stage], peak_memory())
+    return result
+
+def bench_strand(config, limits, report):
+    """
+    Runs the steps of deal_with_ts.contig_ends and classify on every contig
+    of a strand, adding the time of each step to its stage.
+    """
+    ts_counts = timed(report, "read", deal_with_ts.read_counts,
+                      config.feature_file)
+    non_ts_counts = timed(report, "read", deal_with_ts.read_counts,
+                          config.feature_file.replace("_ts", ""))
+    for contig, (positions, counts) in ts_counts.items():
+        table = SiteTable.from_counts(contig, positions, counts)
+        report["sites"] += len(table)
+        table = deal_with_ts.sort_sites(table, config.feature)
+        table = timed(report, "coverage", deal_with_ts.add_coverages, table,
+                      config, contig)
+        table = timed(report, "greatest", deal_with_ts.add_greatest, table,
+                      config)
+        table = timed(report, "get10", deal_with_ts.add_windows, table,
+                      config, ts_counts, non_ts_counts)
+        qualified = table["is_qualified"]
+        A_list = timed(report, "A-count", deal_with_ts.site_As, table,
+                       config, qualified)
+        timed(report, "classification", deal_with_ts.decide, table, A_list,
+              qualified, config.multiplier, limits)
+
+def output_files(args):
+    return [args.prefix + "_ts_l3_tes.tsv",
+            args.prefix + "_ts_r3_tes.tsv",
+            "{}_ts_tesw{}.gff3".format(args.prefix, args.wobble),
+            args.prefix + "_not_ts_tes.gff3"]
+
+def digest(path):
+    """
+    Hashes the sorted lines of an output file, so that the digest depends on
+    the calls but not on the order of the contigs.
+    """
+    with open(path, "rb") as ofile:
+        lines = sorted(ofile.read().splitlines())
+    return hashlib.sha256(b"\n".join(lines)).hexdigest()
+
+def launcher_args(prefix, threads):
+    """
+    Returns the default launcher arguments for a synthetic sample.
+    """
+    parser = ArgumentParser()
+    parser.add_argument("prefix")
+    ts_launcher.add_options(parser)
+    return parser.parse_args([prefix,
+                              "-r", prefix + "_reference.fasta",
+                              "-p", str(threads)])
+
+def bench_size(directory, sites, contigs, seed, threads):
+    """
+    Generates a sample of the given size, times the stages of the filter one
+    by one and then runs the whole filter on it. The gff stage needs the
+    outputs of the whole run, so it is timed last. Returns the report of the
+    sample.
+    """
+    prefix = os.path.join(directory, "bench{}".format(sites))
+    generate(prefix, sites, contigs, seed)
+    args = launcher_args(prefix, threads)
+    report = {"size": sites,
+              "sites": 0,
+              "seconds": dict.fromkeys(STAGES, 0.0),
+              "peak_mb": dict.fromkeys(STAGES, 0.0)}
+    limits = deal_with_ts.limit_table(args.dictionary)
+    args.coverage_store = timed(report, "load", open_coverage,
+                                prefix + "_out_allcov.tsv")
+    args.reference_store = timed(report, "load", Reference, args.reference)
+    for feature in ["l3", "r3"]:
+        config = deal_with_ts.pass_config(
+            args,
+            feature_file="{}_ts_{}.tsv".format(prefix, feature),
+            coverage_file=prefix + "_out_allcov.tsv",
+            feature=feature)
+        bench_strand(config, limits, report)
+    # the whole run loads its own coverages and reference
+    args = launcher_args(prefix, threads)
+    start = time.perf_counter()
+    ts_launcher.launch(args)
+    report["pipeline_seconds"] = time.perf_counter() - start
+    report["digests"] = {os.path.basename(path).replace(
+                             os.path.basename(prefix), "prefix"): digest(path)
+                         for path in output_files(args)}
+    args.feature = "tes"
+    timed(report, "gff", ts_gff.ts_gff, args)
+    report["peak_mb"]["total"] = peak_memory()
+    return report
+
+def run_size(directory, sites, contigs, seed, threads):
+    """
+    Runs the benchmark of a size in a forked process, so that the peak
+    memory of a size is not inherited from the previous ones.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        with context.Pool(1) as pool:
+            return pool.apply(bench_size, (directory, sites, contigs, seed,
+                                           threads))
+    return bench_size(directory, sites, contigs, seed, threads)
+
+def summary_table(reports):
+    rows = []
+    for report in reports:
+        for stage in STAGES:
+            seconds = report["seconds"][stage]
+            rows.append([report["size"], stage, seconds,
+                         report["sites"] / seconds if seconds else np.nan,
+                         report["peak_mb"][stage]])
+        rows.append([report["size"], "pipeline", report["pipeline_seconds"],
+                     report["sites"] / report["pipeline_seconds"],
+                     report["peak_mb"]["total"]])
+    return pd.DataFrame(rows, columns=["size",
+                                       "stage",
+                                       "seconds",
+                                       "sites_per_second",
+                                       "peak_mb"])
+
+def check_golden(reports, golden, contigs, seed, update):
+    """
+    Compares the output digests of every size with the golden file and
+    returns the mismatching outputs. Missing sizes, or all of them if update
+    is set, are added to the golden file instead.
+    """
+    expected = {}
+    if os.path.exists(golden):
+        with open(golden) as gfile:
+            expected = json.load(gfile)
+    mismatches = []
+    changed = False
+    for report in reports:
+        key = "{}:{}:{}".format(report["size"], contigs, seed)
+        if update or key not in expected:
+            expected[key] = report["digests"]
+            changed = True
+            continue
+        for name, value in report["digests"].items():
+            if expected[key].get(name) != value:
+                mismatches.append("{} ({})".format(name, key))
+    if changed:
+        with open(golden, "w") as gfile:
+            json.dump(expected, gfile, indent=2, sort_keys=True)
+    return mismatches
+
+def import_times(repeats):
+    """
+    Returns the best wall time in ms of printing the help of every entry
+    point, which is the time of starting Python, importing the modules and
+    parsing the arguments.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = {}
+    for script in ENTRY_POINTS:
+        best = None
+        for repeat in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script, "--help"],
+                           cwd=directory,
+                           stdout=subprocess.DEVNULL,
+                           check=True)
+            seconds = time.perf_counter() - start
+            if best is None or seconds < best:
+                best = seconds
+        times[script] = best * 1000
+    return times
+
+def eager_modules():
+    """
+    Returns the heavy libraries that are loaded by importing the entry
+    points. A lazily imported library has no submodules loaded until it is
+    used.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    code = ("import sys\n"
+            "{}\n"
+            "print(' '.join(name for name in {!r} if any("
+            "module.startswith(name + '.') for module in sys.modules)))"
+            .format("\n".join("import " + script[:-3]
+                              for script in ENTRY_POINTS),
+                    HEAVY_MODULES))
+    answer = subprocess.run([sys.executable, "-c", code],
+                            cwd=directory,
+                            stdout=subprocess.PIPE,
+                            check=True,
+                            universal_newlines=True)
+    return answer.stdout.split()
+
+def check_imports(budget, repeats):
+    """
+    Prints the start-up times of the entry points and returns the problems:
+    the entry points that are slower than the budget in ms, and the heavy
+    libraries that are loaded before they are needed.
+    """
+    problems = []
+    times = import_times(repeats)
+    for script, milliseconds in times.items():
+        print("{:<16} {:7.1f} ms".format(script, milliseconds))
+        if milliseconds > budget:
+            problems.append("{} starts in {:.1f} ms, the budget is {} ms"
+                            .format(script, milliseconds, budget))
+    for name in eager_modules():
+        problems.append("{} is loaded when the entry points are imported"
+                        .format(name))
+    return problems
+
+def bench(args):
+    directory = args.directory or tempfile.mkdtemp(prefix="ts_bench_")
+    os.makedirs(directory, exist_ok=True)
+    try:
+        reports = []
+        for sites in args.sizes:
+            print("Benchmarking {} sites per count file...".format(sites))
+            reports.append(run_size(directory, sites, args.contigs,
+                                    args.seed, args.threads))
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory)
+    table = summary_table(reports)
+    print(table.to_string(index=False, float_format="{:.4g}".format))
+    if args.output:
+        table.to_csv(args.output, index=False, sep="\t")
+    if args.golden:
+        return check_golden(reports, args.golden, args.contigs, args.seed,
+                            args.update_golden)
+    return []
+
+###############################################################################
+###                             Main function                               ###
+###############################################################################
+
+def main():
+    args = parsing()
+    if args.generate:
+        generate(args.generate, args.sizes[0], args.contigs, args.seed)
+        return
+    problems = ["Output changed: {}".format(mismatch)
+                for mismatch in bench(args)]
+    if args.import_budget:
+        print("Start-up times:")
+        problems.extend(check_imports(args.import_budget,
+                                      args.import_repeats))
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(1)
+
+def parsing():
+    parser = ArgumentParser(description="This module benchmarks the \
+                            template-switching filter on synthetic LoRTIA \
+                            outputs of different sizes. It reports the time, \
+                            the throughput and the peak memory of each stage \
+                            and can check that the calls stay the same.")
+    parser.add_argument("-s", "--sizes",
+                        dest="sizes",
+                        help="The numbers of positions in each count file of \
+                        the synthetic samples. The default is 1000 10000 \
+                        100000.",
+                        type=int,
+                        nargs="+",
+                        default=[1000, 10000, 100000],
+                        metavar="[integer]")
+    parser.add_argument("-n", "--contigs",
+                        dest="contigs",
+                        help="The number of contigs of the synthetic \
+                        reference. The default value is 4.",
+                        type=int,
+                        default=4,
+                        metavar="[integer]")
+    parser.add_argument("--seed",
+                        dest="seed",
+                        help="The seed of the synthetic data. The default \
+                        value is 1.",
+                        type=int,
+                        default=1,
+                        metavar="[integer]")
+    parser.add_argument("-p", "--threads",
+                        dest="threads",
+                        help="The number of processes of the whole filter \
+                        run. The stages are timed on one process. The \
+                        default value is 1.",
+                        type=int,
+                        default=1,
+                        metavar="[integer]")
+    parser.add_argument("-o", "--output",
+                        dest="output",
+                        help="A tsv file where the timings are written.",
+                        default=None,
+                        metavar="[file]")
+    parser.add_argument("--golden",
+                        dest="golden",
+                        help="A json file with the digests of the outputs of \
+                        earlier runs. The run fails if the calls of a size \
+                        have changed. Sizes that are not in the file yet are \
+                        added to it.",
+                        default=None,
+                        metavar="[file]")
+    parser.add_argument("--update_golden",
+                        dest="update_golden",
+                        help="Overwrite the digests in the golden file with \
+                        the ones of this run.",
+                        action="store_true")
+    parser.add_argument("--import_budget",
+                        dest="import_budget",
+                        help="The largest number of ms that printing the help \
+                        of an entry point may take. The run fails if an entry \
+                        point is slower or if it loads numpy, pandas, pyarrow \
+                        or pysam before they are needed. 0 skips the check. \
+                        The default value is 250.",
+                        type=float,
+                        default=250,
+                        metavar="[float]")
+    parser.add_argument("--import_repeats",
+                        dest="import_repeats",
+                        help="The number of times the start-up of each entry \
+                        point is timed, the best time is kept. The default \
+                        value is 5.",
+                        type=int,
+                        default=5,
+                        metavar="[integer]")
+    parser.add_argument("--directory",
+                        dest="directory",
+                        help="Keep the synthetic samples and the outputs in \
+                        this directory. By default a temporary directory is \
+                        used and removed.",
+                        default=None,
+                        metavar="[directory]")
+    parser.add_argument("--generate",
+                        dest="generate",
+                        help="Only write a synthetic sample of the first size \
+                        with this prefix.",
+                        default=None,
+                        metavar="[prefix]")
+    return parser.parse_args()
+
+
+if __name__== "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import pickle
+from ts_lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+# Changing the layout of the cached tables invalidates the old entries.
+CACHE_VERSION = 2
+
+def file_fingerprint(path):
+    """
+    Fingerprints an input file by its absolute path, size and modification
+    time, which is cheap even for files of tens of GB.
+    """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+def cache_key(*parts):
+    """
+    Hashes json-serializable parts into a cache key.
+    """
+    text = json.dumps([CACHE_VERSION] + list(parts), sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+class SiteCache:
+    """
+    A content-addressed directory of pickled per-contig tables. When the
+    directory grows larger than max_bytes, the least recently used tables are
+    evicted. Eviction scans the whole directory, so it is left to the caller
+    to run it once after a batch of tables is saved.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def get(self, key):
+        """
+        Returns the table stored under the key, or None.
+        """
+        path = self.path(key)
+        try:
+            table = pd.read_pickle(path)
+        except (OSError, EOFError, ValueError, AttributeError,
+                pickle.UnpicklingError):
+            return None
+        try:
+            # the modification time marks the last use
+            os.utime(path)
+        except OSError:
+            pass
+        return table
+
+    def put(self, key, table):
+        path = self.path(key)
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        pd.to_pickle(table, temporary)
+        os.replace(temporary, path)
+
+    def evict(self):
+        """
+        Removes the least recently used tables until the cache fits into
+        max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pkl"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
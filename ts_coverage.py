@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+import hashlib
+import io
+import json
+import mmap
+import os
+from argparse import ArgumentParser
+from ts_lazy import lazy_import
+from ts_stream import contig_blocks, read_block, tsv_contig
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+BINARY_MAGIC = b"TSCOV\x00\x01\x00"
+
+def write_arrays(path, arrays, dtype, magic):
+    """
+    Writes a dict of contig: array to a binary file. The file starts with
+    the magic bytes, the length of a json header and the header, which lists
+    the dtype and the offset and length of each contig. The arrays follow,
+    each aligned to 8 bytes.
+    """
+    write_pieces(path,
+                 {name: len(array) for name, array in arrays.items()},
+                 arrays.items(),
+                 dtype,
+                 magic)
+
+def write_pieces(path, lengths, pieces, dtype, magic):
+    """
+    Writes arrays of known lengths to a binary file like write_arrays, but
+    from (contig, piece) pairs that give the arrays piece by piece in the
+    order of the lengths, so that the arrays are never in memory at once.
+    """
+    dtype = np.dtype(dtype)
+    names = list(lengths)
+    header_length = 0
+    while True:
+        offset = len(magic) + 8 + header_length
+        contigs = []
+        for name in names:
+            offset += -offset % 8
+            contigs.append([name, offset, lengths[name]])
+            offset += lengths[name] * dtype.itemsize
+        header = json.dumps({"dtype": dtype.str,
+                             "contigs": contigs}).encode()
+        if len(header) == header_length:
+            break
+        header_length = len(header)
+    offsets = {name: offset for name, offset, length in contigs}
+    with open(path, "wb") as bfile:
+        bfile.write(magic)
+        bfile.write(len(header).to_bytes(8, "little"))
+        bfile.write(header)
+        current = None
+        for name, piece in pieces:
+            if name != current:
+                bfile.write(b"\x00" * (offsets[name] - bfile.tell()))
+                current = name
+            bfile.write(np.ascontiguousarray(piece, dtype=dtype).tobytes())
+
+def read_arrays(path, magic):
+    """
+    Memory-maps a file written by write_arrays and returns a dict of
+    contig: read-only array views of the map, without copying the data.
+    """
+    with open(path, "rb") as bfile:
+        if bfile.read(len(magic)) != magic:
+            raise ValueError("{} is not a binary file of the expected "
+                             "type.".format(path))
+        header_length = int.from_bytes(bfile.read(8), "little")
+        header = json.loads(bfile.read(header_length))
+        data = mmap.mmap(bfile.fileno(), 0, access=mmap.ACCESS_READ)
+    dtype = np.dtype(header["dtype"])
+    return {name: np.frombuffer(data, dtype=dtype, count=length,
+                                offset=offset)
+            for name, offset, length in header["contigs"]}
+
+def dense_array(positions, counts):
+    """
+    Returns a uint32 array of the counts indexed by the positions. Missing
+    positions have a coverage of 0.
+    """
+    if len(positions) == 0:
+        return np.zeros(0, dtype=np.uint32)
+    array = np.zeros(positions.max() + 1, dtype=np.uint32)
+    array[positions] = counts
+    return array
+
+def window_sums(array, starts, ends):
+    """
+    Sums a coverage array in the [start, end) windows for whole vectors of
+    window starts and ends at once, using a cumulative sum of the part of the
+    array that the windows span.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.clip(starts, 0, len(array))
+    ends = np.clip(ends, 0, len(array))
+    low = starts.min()
+    cumulative = np.zeros(ends.max() - low + 1, dtype=np.int64)
+    np.cumsum(array[low:ends.max()], out=cumulative[1:])
+    return cumulative[ends - low] - cumulative[starts - low]
+
+def array_fingerprint(array):
+    """
+    Hashes the contents of a coverage array.
+    """
+    return hashlib.sha256(memoryview(np.ascontiguousarray(array))
+                          ).hexdigest()
+
+def binary_path(coverage_file):
+    """
+    Returns the path of the binary cache of a coverage tsv file.
+    """
+    return os.path.splitext(coverage_file)[0] + ".covbin"
+
+class CoverageStore:
+    """
+    Holds the coverages of every contig as dense arrays indexed by position,
+    so that the coverage file only has to be read once per run and can be
+    queried by both strands and all contigs.
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    @classmethod
+    def from_tsv(cls, coverage_file, chunksize=5000000):
+        """
+        Reads a contig, position, coverage tsv file chunk by chunk.
+        """
+        positions = {}
+        counts = {}
+        reader = pd.read_csv(coverage_file,
+                             sep="\t",
+                             names=["contig", "pos", "count"],
+                             dtype={"contig": str,
+                                    "pos": np.int64,
+                                    "count": np.int64},
+                             chunksize=chunksize)
+        for chunk in reader:
+            for contig, group in chunk.groupby("contig", sort=False):
+                positions.setdefault(contig, []).append(
+                        group["pos"].to_numpy())
+                counts.setdefault(contig, []).append(
+                        group["count"].to_numpy())
+        arrays = {contig: dense_array(np.concatenate(positions[contig]),
+                                      np.concatenate(counts[contig]))
+                  for contig in positions}
+        return cls(arrays)
+
+    @classmethod
+    def from_binary(cls, binary_file):
+        """
+        Memory-maps a binary coverage file written by to_binary.
+        """
+        return cls(read_arrays(binary_file, BINARY_MAGIC))
+
+    def to_binary(self, binary_file):
+        write_arrays(binary_file, self.arrays, "<u4", BINARY_MAGIC)
+
+    def array(self, contig):
+        """
+        Returns the coverage array of a contig. Positions that are missing
+        from the coverage file have a coverage of 0.
+        """
+        if contig in self.arrays:
+            return self.arrays[contig]
+        return np.zeros(0, dtype=np.uint32)
+
+    def window_sums(self, contig, starts, ends):
+        """
+        Sums the coverages in the [start, end) windows of a contig.
+        """
+        return window_sums(self.array(contig), starts, ends)
+
+    def fingerprint(self, contig):
+        """
+        Returns a hash of the coverages of a contig, which changes only if
+        the coverages of the contig change.
+        """
+        return array_fingerprint(self.array(contig))
+
+class StreamingCoverage:
+    """
+    Reads the coverages from a coverage tsv that is sorted by contig, one
+    contig at a time. Only the last contig that was queried is kept in
+    memory.
+    """
+    def __init__(self, coverage_file):
+        self.coverage_file = coverage_file
+        self.blocks = contig_blocks(coverage_file, tsv_contig)
+        self.contig = None
+        self.current = np.zeros(0, dtype=np.uint32)
+
+    def array(self, contig):
+        if contig != self.contig:
+            self.current = np.zeros(0, dtype=np.uint32)
+            if contig in self.blocks:
+                cov = pd.read_csv(io.BytesIO(read_block(self.coverage_file,
+                                                        self.blocks[contig])),
+                                  sep="\t",
+                                  names=["contig", "pos", "count"],
+                                  dtype={"contig": str,
+                                         "pos": np.int64,
+                                         "count": np.int64})
+                self.current = dense_array(cov["pos"].to_numpy(),
+                                           cov["count"].to_numpy())
+            self.contig = contig
+        return self.current
+
+    def window_sums(self, contig, starts, ends):
+        return window_sums(self.array(contig), starts, ends)
+
+    def fingerprint(self, contig):
+        return array_fingerprint(self.array(contig))
+
+class BamCoverage:
+    """
+    Reads the coverages from an indexed bam file, but only in the windows that
+    are queried. Overlapping windows are merged into a single region query.
+    Positions are 1-based, like in the coverage tsv files.
+    """
+    def __init__(self, bam_file):
+        self.bam_file = bam_file
+        self.open()
+
+    def open(self):
+        try:
+            import pysam
+        except ImportError:
+            raise ImportError("Reading coverages from bam files requires "
+                              "the pysam package.")
+        self.bam = pysam.AlignmentFile(self.bam_file, "rb")
+        self.lengths = dict(zip(self.bam.references, self.bam.lengths))
+        self.pid = os.getpid()
+
+    def depth(self, contig, start, end):
+        """
+        Returns the depth of the 1-based [start, end) region of a contig. The
+        parts of the region outside the contig have a depth of 0.
+        """
+        depth = np.zeros(end - start, dtype=np.int64)
+        low = max(start, 1)
+        high = min(end, self.lengths.get(contig, 0) + 1)
+        if high > low:
+            counts = self.bam.count_coverage(contig,
+                                             low - 1,
+                                             high - 1,
+                                             quality_threshold=0,
+                                             read_callback="all")
+            depth[low - start:high - start] = np.sum(counts, axis=0)
+        return depth
+
+    def window_sums(self, contig, starts, ends):
+        """
+        Sums the coverages in the [start, end) windows of a contig. The
+        windows are sorted and merged into regions, the depth of each region
+        is read once and the windows are summed from one cumulative sum of
+        all the regions.
+        """
+        if self.pid != os.getpid():
+            # a forked worker must not share the file handle of its parent
+            self.open()
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if len(starts) == 0:
+            return np.zeros(0, dtype=np.int64)
+        order = np.argsort(starts, kind="stable")
+        starts = starts[order]
+        ends = ends[order]
+        reach = np.maximum.accumulate(ends)
+        is_new = np.concatenate(([True], starts[1:] >= reach[:-1]))
+        region = np.cumsum(is_new) - 1
+        region_starts = starts[is_new]
+        region_ends = np.maximum.reduceat(ends, np.flatnonzero(is_new))
+        depths = [self.depth(contig, start, end)
+                  for start, end in zip(region_starts, region_ends)]
+        offsets = np.concatenate(([0], np.cumsum(region_ends
+                                                 - region_starts)))
+        cumulative = np.concatenate(([0], np.cumsum(np.concatenate(depths))))
+        first = offsets[region] + starts - region_starts[region]
+        last = offsets[region] + ends - region_starts[region]
+        sums = np.empty(len(order), dtype=np.int64)
+        sums[order] = cumulative[last] - cumulative[first]
+        return sums
+
+    def fingerprint(self, contig):
+        """
+        Returns the size and modification time of the bam file. Reading the
+        coverages of whole contigs would take as long as filtering them, so
+        any change of the bam file counts as a change of every contig.
+        """
+        stat = os.stat(self.bam_file)
+        return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+def coverage_source(coverage_file):
+    """
+    Returns the file that the coverages of a coverage file are read from:
+    the binary cache of a tsv file if it is newer than the tsv, or if the tsv
+    was removed after the conversion, and otherwise the file itself.
+    """
+    if coverage_file.endswith((".bam", ".covbin")):
+        return coverage_file
+    cache = binary_path(coverage_file)
+    if os.path.exists(cache) and (
+            not os.path.exists(coverage_file)
+            or os.path.getmtime(cache) >= os.path.getmtime(coverage_file)):
+        return cache
+    return coverage_file
+
+def open_coverage(coverage_file, streaming=False):
+    """
+    Opens a coverage source according to its extension: bam files are read
+    region by region, binary coverage files are memory-mapped and anything
+    else is read as a coverage tsv, either whole or, when streaming, contig
+    by contig. The binary cache of a tsv file is used instead of the tsv as
+    long as it is newer than the tsv.
+    """
+    source = coverage_source(coverage_file)
+    if source.endswith(".bam"):
+        return BamCoverage(source)
+    if source.endswith(".covbin"):
+        return CoverageStore.from_binary(source)
+    if streaming:
+        return StreamingCoverage(source)
+    return CoverageStore.from_tsv(source)
+
+###############################################################################
+###                             Main function                               ###
+###############################################################################
+
+def main():
+    args = parsing()
+    output = args.output or binary_path(args.coverage_file)
+    print("Converting {} to {}...".format(args.coverage_file, output))
+    CoverageStore.from_tsv(args.coverage_file).to_binary(output)
+
+def parsing():
+    parser = ArgumentParser(description="This module converts a coverage \
+                            tsv file into a binary file that can be \
+                            memory-mapped by the template-switching filter. \
+                            The binary file is used instead of the tsv \
+                            whenever it is newer than the tsv.")
+    parser.add_argument("coverage_file",
+                        help="The tsv file which contains the coverages.\
+                        The tsv file should contain 3 columns: contig, \
+                        position and coverage.",
+                        metavar="coverage_file")
+    parser.add_argument("-o", "--output",
+                        dest="output",
+                        help="The binary file to be written. By default the \
+                        extension of the coverage file is replaced by \
+                        .covbin.",
+                        default=None,
+                        metavar="[binary_file]")
+    return parser.parse_args()
+
+
+if __name__== "__main__":
+    main()
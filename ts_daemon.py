@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+import json
+import multiprocessing
+import os
+import time
+import urllib.error
+import urllib.request
+from argparse import REMAINDER, ArgumentParser
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import deal_with_ts
+import ts_launcher
+from ts_cache import file_fingerprint
+from ts_coverage import binary_path, open_coverage
+from ts_reference import Reference, track_path
+
+class LRUCache:
+    """
+    Keeps the most recently used items, up to maxsize of them.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self, key, load):
+        """
+        Returns the item of the key, loading it with the load function if it
+        is not cached yet.
+        """
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key]
+        item = load()
+        self.items[key] = item
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+        return item
+
+def fingerprints(*paths):
+    """
+    Fingerprints the files that exist among the paths, so that a cached item
+    is reloaded when any of its files change.
+    """
+    return json.dumps([file_fingerprint(path) for path in paths
+                       if os.path.exists(path)])
+
+def job_parser():
+    """
+    Returns the parser of the launcher arguments of a job.
+    """
+    parser = ArgumentParser(prog="job", add_help=False)
+    parser.add_argument("prefix")
+    ts_launcher.add_options(parser)
+    return parser
+
+class FilterServer(HTTPServer):
+    """
+    A single-threaded HTTP server on localhost that queues filtering jobs
+    and runs each on a forked process. The references, limit tables and
+    coverages are loaded in the server process and cached, so the jobs
+    inherit them without loading anything.
+    """
+    def __init__(self, port, workers, references, coverages):
+        HTTPServer.__init__(self, ("127.0.0.1", port), JobHandler)
+        # handle_request returns after this many seconds without requests,
+        # so that finished jobs are collected
+        self.timeout = 0.2
+        self.workers = workers
+        self.references = LRUCache(references)
+        self.limits = LRUCache(16)
+        self.coverages = LRUCache(coverages)
+        self.context = multiprocessing.get_context("fork")
+        self.jobs = OrderedDict()
+        self.queue = []
+        self.running = {}
+        self.stopping = False
+
+    def submit(self, job_args):
+        """
+        Parses the launcher arguments of a job and queues it. Returns the
+        job or raises ValueError if the arguments are invalid.
+        """
+        try:
+            args = job_parser().parse_args(job_args)
+        except SystemExit:
+            raise ValueError("Invalid arguments: {}".format(
+                             " ".join(job_args)))
+        job = {"id": len(self.jobs) + 1,
+               "prefix": args.prefix,
+               "status": "queued",
+               "exitcode": None,
+               "seconds": None}
+        self.jobs[job["id"]] = job
+        self.queue.append((job, args))
+        return job
+
+    def load(self, args):
+        """
+        Sets the cached reference, limit table and coverages of a job.
+        """
+        args.reference_store = self.references.get(
+            fingerprints(args.reference, track_path(args.reference)),
+            lambda: Reference(args.reference))
+        args.limits = self.limits.get(
+            fingerprints(args.dictionary),
+            lambda: deal_with_ts.limit_table(args.dictionary))
+        coverage_file = ts_launcher.coverage_path(args)
+        args.coverage_store = self.coverages.get(
+            fingerprints(coverage_file, binary_path(coverage_file))
+            + str(args.streaming),
+            lambda: open_coverage(coverage_file, args.streaming))
+
+    def service(self):
+        """
+        Collects the finished jobs and starts queued jobs on the free
+        workers.
+        """
+        for job_id, (process, start) in list(self.running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            job = self.jobs[job_id]
+            job["exitcode"] = process.exitcode
+            job["seconds"] = time.time() - start
+            job["status"] = "done" if process.exitcode == 0 else "failed"
+            del self.running[job_id]
+        while self.queue and len(self.running) < self.workers:
+            job, args = self.queue.pop(0)
+            try:
+                self.load(args)
+            except Exception as error:
+                job["status"] = "failed"
+                job["error"] = str(error)
+                continue
+            process = self.context.Process(target=ts_launcher.launch,
+                                           args=(args,))
+            process.start()
+            job["status"] = "running"
+            self.running[job["id"]] = (process, time.time())
+
+    def serve(self):
+        """
+        Serves requests until a shutdown is requested and the queued and
+        running jobs are finished.
+        """
+        while not self.stopping or self.running or self.queue:
+            self.handle_request()
+            self.service()
+        self.server_close()
+
+class JobHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs with a json list of launcher arguments queues a job, GET
+    /jobs/[id] returns its state, GET /status the state of the server and
+    POST /shutdown stops the server after the queued and running jobs.
+    """
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        if self.path == "/status":
+            self.reply(200, {"queued": len(server.queue),
+                             "running": len(server.running),
+                             "jobs": len(server.jobs),
+                             "references": len(server.references.items),
+                             "coverages": len(server.coverages.items)})
+        elif self.path.startswith("/jobs/"):
+            try:
+                job = server.jobs[int(self.path[len("/jobs/"):])]
+            except (ValueError, KeyError):
+                self.reply(404, {"error": "No such job."})
+                return
+            self.reply(200, job)
+        else:
+            self.reply(404, {"error": "Unknown path."})
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path == "/jobs":
+            if server.stopping:
+                self.reply(503, {"error": "The server is shutting down."})
+                return
+            try:
+                job_args = json.loads(body)
+                if (not isinstance(job_args, list)
+                        or not all(isinstance(i, str) for i in job_args)):
+                    raise ValueError("A list of arguments is expected.")
+                job = server.submit(job_args)
+            except ValueError as error:
+                self.reply(400, {"error": str(error)})
+                return
+            self.reply(202, job)
+        elif self.path == "/shutdown":
+            server.stopping = True
+            self.reply(200, {"running": len(server.running)})
+        else:
+            self.reply(404, {"error": "Unknown path."})
+
+    def log_message(self, format, *args):
+        pass
+
+def request(port, method, path, body=None):
+    """
+    Sends a request to the server and returns the decoded json answer.
+    """
+    data = None if body is None else json.dumps(body).encode()
+    req = urllib.request.Request("http://127.0.0.1:{}{}".format(port, path),
+                                 data=data,
+                                 method=method)
+    try:
+        with urllib.request.urlopen(req) as answer:
+            return json.loads(answer.read())
+    except urllib.error.HTTPError as error:
+        return json.loads(error.read())
+
+def submit(args):
+    """
+    Submits a job to the server and waits until it is finished. Returns the
+    final state of the job.
+    """
+    job = request(args.port, "POST", "/jobs", args.job)
+    if "error" in job:
+        return job
+    while job["status"] in ["queued", "running"]:
+        time.sleep(args.poll)
+        job = request(args.port, "GET", "/jobs/{}".format(job["id"]))
+    return job
+
+###############################################################################
+###                             Main function                               ###
+###############################################################################
+
+def main():
+    args = parsing()
+    if args.command == "serve":
+        server = FilterServer(args.port, args.workers, args.references,
+                              args.coverages)
+        print("Serving filtering jobs on 127.0.0.1:{}...".format(args.port))
+        server.serve()
+    elif args.command == "submit":
+        job = submit(args)
+        print(json.dumps(job))
+        if job.get("status") != "done":
+            raise SystemExit(1)
+    else:
+        print(json.dumps(request(args.port, "POST", "/shutdown", {})))
+
+def parsing():
+    parser = ArgumentParser(description="This module runs the \
+                            template-switching filter as a server on \
+                            localhost. The references, limit tables and \
+                            coverages of recent jobs are kept in memory, so \
+                            later jobs on the same files do not load them \
+                            again. The outputs of a job are the same as those\
+                            of ts_launcher.py.")
+    parser.add_argument("--port",
+                        dest="port",
+                        help="The port of the server on 127.0.0.1. The \
+                        default value is 8765.",
+                        type=int,
+                        default=8765,
+                        metavar="[integer]")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="Start the server.")
+    serve.add_argument("-w", "--workers",
+                       dest="workers",
+                       help="The number of jobs that run at the same time. \
+                       The default value is 2.",
+                       type=int,
+                       default=2,
+                       metavar="[integer]")
+    serve.add_argument("--references",
+                       dest="references",
+                       help="The number of references that are kept in \
+                       memory. The default value is 4.",
+                       type=int,
+                       default=4,
+                       metavar="[integer]")
+    serve.add_argument("--coverages",
+                       dest="coverages",
+                       help="The number of coverage files that are kept in \
+                       memory. The default value is 4.",
+                       type=int,
+                       default=4,
+                       metavar="[integer]")
+    submit = commands.add_parser("submit",
+                                 help="Submit a job and wait for it. The \
+                                 arguments are the same as those of \
+                                 ts_launcher.py.")
+    submit.add_argument("--poll",
+                        dest="poll",
+                        help="The seconds between two queries of the state \
+                        of the job. The default value is 0.5.",
+                        type=float,
+                        default=0.5,
+                        metavar="[float]")
+    submit.add_argument("job",
+                        help="The prefix and the options of the job.",
+                        nargs=REMAINDER)
+    commands.add_parser("shutdown",
+                        help="Stop the server after the queued and running \
+                        jobs.")
+    return parser.parse_args()
+
+
+if __name__== "__main__":
+    main()
@@ -1,120 +1,249 @@
 #!/usr/bin/env python3
 
+import json
+import os
 from argparse import ArgumentParser
-import pandas as pd
+from ts_cache import file_fingerprint
+from ts_lazy import lazy_import
+from ts_pool import map_forked, shared, sharing
+from ts_profile import profiling, stage
+from ts_table import EXTENSIONS, read_table
 
-def line_end(df, n_df, feature, sign):
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# The columns of the summary tables that the gff lines are made of
+TABLE_COLUMNS = ["contig", "pos", "count", "feature"]
+# Their types, the features only take a few values
+TABLE_DTYPES = {"count": "int32", "feature": "category"}
+
+GFF_COLUMNS = ["contig",
+               "source",
+               "feature",
+               "start",
+               "end",
+               "score",
+               "strand",
+               "frame",
+               "info"]
+
+def read_sites(path, table_format):
+    """
+    Reads the columns of a summary table that the gff lines are made of.
+    """
+    if table_format == "parquet":
+        return read_table(path, "parquet", TABLE_COLUMNS).astype(TABLE_DTYPES)
+    return pd.read_csv(path, sep="\t", usecols=TABLE_COLUMNS,
+                       dtype=TABLE_DTYPES)
+
+def line_end(df, feature, sign):
+    """
+    Prepares gff lines for transcript ends (TSS and TES).
+    """
+    rows = df.loc[df["feature"] == feature]
+    return pd.DataFrame({"contig": rows["contig"].to_numpy(),
+                         "source": "LoRTIA",
+                         "feature": feature,
+                         "start": rows["pos"].to_numpy(),
+                         "end": rows["pos"].to_numpy(),
+                         "score": rows["count"].to_numpy(),
+                         "strand": sign,
+                         "frame": ".",
+                         "info": rows["count"].to_numpy()},
+                        columns=GFF_COLUMNS)
+
+def cluster(start, score, wobble, leftmost, is_new):
+    """
+    Clusters the positions of consecutive partitions, each sorted by start,
+    that are within the wobble of the previous position of their partition.
+    Returns the mask of the left- or rightmost of the positions with the
+    highest score in each cluster. is_new marks the first position of every
+    partition and leftmost the positions of the partitions where the
+    leftmost position is picked.
+    """
+    if len(start) == 0:
+        return np.zeros(0, dtype=bool)
+    is_first = np.concatenate(([True], np.diff(start) > wobble)) | is_new
+    bounds = np.flatnonzero(is_first)
+    ids = np.cumsum(is_first) - 1
+    is_greatest = score == np.maximum.reduceat(score, bounds)[ids]
+    lowest = np.minimum.reduceat(np.where(is_greatest, start, start.max()),
+                                 bounds)
+    highest = np.maximum.reduceat(np.where(is_greatest, start, start.min()),
+                                  bounds)
+    extreme = np.where(leftmost[bounds], lowest, highest)
+    return is_greatest & (start == extreme[ids])
+
+def cluster_chunk(chunk):
+    """
+    Clusters the rows of a chunk of whole partitions of the gff lines shared
+    by ts_gff.
+    """
+    first, last = chunk
+    with stage("gff cluster", rows=last - first):
+        return cluster(shared["start"][first:last],
+                       shared["score"][first:last],
+                       shared["wobble"],
+                       shared["leftmost"][first:last],
+                       shared["is_new"][first:last])
+
+def chunk_bounds(is_new, chunks):
+    """
+    Splits the rows into up to the given number of chunks of about the same
+    size, without splitting partitions, and returns their first and last
+    rows.
+    """
+    firsts = np.append(np.flatnonzero(is_new), len(is_new))
+    targets = np.linspace(0, len(is_new), chunks + 1)[1:-1]
+    cuts = np.unique(np.concatenate(([0], firsts[np.searchsorted(firsts,
+                                                                 targets)],
+                                     [len(is_new)])))
+    return [(int(first), int(last))
+            for first, last in zip(cuts[:-1], cuts[1:])]
+
+def feature_strand(feature):
     """
-    Prepares gff line for transcript ends (TSS and TES).
+    Returns the strand of the gff lines of a summary table.
     """
-    for index, row in df.iterrows():
-        i = len(n_df)
-        if row["feature"] == feature:
-            n_df.loc[i] = [row["contig"],
-                             "LoRTIA", 
-                             feature,
-                             row["pos"],
-                             row["pos"],
-                             row["count"],
-                             sign,
-                             ".",
-                             row["count"]]
-            i += 1
+    if feature in ["r3", "l5"]:
+        return "+"
+    return "-"
 
-def ts_gff(args):
+def is_in(lines, partitions):
     """
-    Creates template switching gffs from stats files.
+    Returns the mask of the gff lines that belong to the given contig and
+    strand partitions. The contigs are compared as strings, because the
+    contigs of a tsv can be read as numbers.
+    """
+    return np.array([(str(contig), strand) in partitions for contig, strand
+                     in zip(lines["contig"], lines["strand"])], dtype=bool)
+
+def gff_state(args, feat_file):
+    """
+    Returns the inputs and settings that the gff files depend on, apart from
+    the summary tables.
+    """
+    return {"gff": file_fingerprint(feat_file),
+            "wobble": args.wobble,
+            "format": args.intermediate_format}
+
+def sort_lines(lines):
+    """
+    Sorts gff lines by contig and start, and the strands of a position in the
+    order of the partitions.
+    """
+    return lines.sort_values(by=["contig", "start", "strand"], kind="stable")
+
+def splice(gff_file, lines, partitions, args):
+    """
+    Replaces the lines of the given partitions in an earlier gff file with
+    their new lines.
+    """
+    if os.path.getsize(gff_file) == 0:
+        return lines
+    old = pd.read_csv(gff_file, sep="\t", header=None, names=GFF_COLUMNS)
+    if args.intermediate_format == "parquet":
+        old["contig"] = old["contig"].astype(str)
+    frames = [frame for frame in [old.loc[~is_in(old, partitions)], lines]
+              if len(frame)]
+    if not frames:
+        return lines
+    return sort_lines(pd.concat(frames, ignore_index=True))
+
+def ts_gff(args, partitions=None):
+    """
+    Creates template switching gffs from stats files. If the contig and
+    strand partitions whose summary table rows have changed are given, only
+    these are clustered again and spliced into the gff files of the last
+    incremental run.
     """
     print("Creating {} template-switching gff files...".format(args.feature))
-    cols = ["contig",
-            "source",
-            "feature",
-            "start",
-            "end",
-            "score",
-            "strand",
-            "frame",
-            "info"]
-    new_df = pd.DataFrame(columns=cols)
+    extension = EXTENSIONS[args.intermediate_format]
     if args.feature == "tss":
-        filepos = "{}_ts_l5_{}.tsv".format(args.prefix, args.feature)
-        fileneg = "{}_ts_r5_{}.tsv".format(args.prefix, args.feature)
+        filepos = "{}_ts_l5_{}{}".format(args.prefix, args.feature, extension)
+        fileneg = "{}_ts_r5_{}{}".format(args.prefix, args.feature, extension)
     else:
-        filepos = "{}_ts_r3_{}.tsv".format(args.prefix, args.feature)
-        fileneg = "{}_ts_l3_{}.tsv".format(args.prefix, args.feature)
-    dfpos = pd.read_csv(filepos, sep = "\t")
-    dfneg = pd.read_csv(fileneg, sep = "\t")
-    line_end(dfpos, new_df, args.feature, "+")
-    line_end(dfneg, new_df, args.feature, "-")
-    ts_df = pd.DataFrame(columns=cols)
-    line_end(dfpos, ts_df, "Template-switching", "+")
-    line_end(dfneg, ts_df, "Template-switching", "-")
-    feat_gff = pd.read_csv("{}_{}.gff3".format(args.prefix, args.feature),
-                           sep="\t",
-                           header=None,
-                           names=cols)
-    alldfs = pd.concat([new_df, ts_df, feat_gff])
-    summary = pd.DataFrame(columns=cols)
-    for strand in set(alldfs["strand"]):
-        stranddf = alldfs.loc[alldfs.strand == strand].copy()
-        stranddf = stranddf.sort_values(by="start")
-        counter = 0
-        ID_list = []
-        prev = -999
-        for index, row in stranddf.iterrows():
-            if prev not in range(row["start"] - args.wobble, row["start"] 
-                             + args.wobble + 1):
-                counter += 1
-            ID_list.append(strand+str(counter))
-            prev = row["start"]
-        stranddf["ID"] = ID_list
-        is_greatest_list = []
-        for index, row in stranddf.iterrows():
-            maximum = stranddf.loc[stranddf.ID == row["ID"]]["score"].max()
-            is_greatest = row["score"] == maximum
-            is_greatest_list.append(is_greatest)
-        stranddf["is_greatest"] = is_greatest_list
-        if (strand == "-" and args.feature == ("tes")) or (strand == "+" 
-           and args.feature == ("tss")):
-            leftmost = True
-        else:
-            leftmost = False
-        is_picked_list = []
-        if leftmost:
-            for index, row in stranddf.iterrows():
-                if row["is_greatest"]:
-                    subdf = stranddf.loc[(stranddf.ID == row["ID"]) & (
-                            stranddf.is_greatest == True)]
-                    is_picked = row["start"] == subdf["start"].min()
-                else:
-                    is_picked = False
-                is_picked_list.append(is_picked)
+        filepos = "{}_ts_r3_{}{}".format(args.prefix, args.feature, extension)
+        fileneg = "{}_ts_l3_{}{}".format(args.prefix, args.feature, extension)
+    with stage("gff read") as record:
+        dfpos = read_sites(filepos, args.intermediate_format)
+        dfneg = read_sites(fileneg, args.intermediate_format)
+        new_df = pd.concat([line_end(dfpos, args.feature, "+"),
+                            line_end(dfneg, args.feature, "-")])
+        ts_df = pd.concat([line_end(dfpos, "Template-switching", "+"),
+                           line_end(dfneg, "Template-switching", "-")])
+        feat_file = "{}_{}.gff3".format(args.prefix, args.feature)
+        feat_gff = pd.read_csv(feat_file,
+                               sep="\t",
+                               header=None,
+                               names=GFF_COLUMNS)
+        if args.intermediate_format == "parquet":
+            # the contigs of parquet tables are always strings
+            feat_gff["contig"] = feat_gff["contig"].astype(str)
+        alldfs = pd.concat([new_df, ts_df, feat_gff])
+        record["rows"] = len(alldfs)
+    ts_file = "{}_ts_{}.gff3".format(args.prefix, args.feature + "w"
+                                     + str(args.wobble))
+    feature_file = "{}_not_ts_{}.gff3".format(args.prefix, args.feature)
+    state_file = "{}_ts_{}_gff.json".format(args.prefix, args.feature)
+    state = gff_state(args, feat_file)
+    if partitions is not None:
+        try:
+            with open(state_file) as sfile:
+                stored = json.load(sfile)
+        except (OSError, ValueError):
+            stored = None
+        if (stored != state or not os.path.exists(ts_file)
+                or not os.path.exists(feature_file)):
+            partitions = None
         else:
-            for index, row in stranddf.iterrows():
-                if row["is_greatest"]:
-                    subdf = stranddf.loc[(stranddf.ID == row["ID"]) & (
-                            stranddf.is_greatest == True)]
-                    is_picked = row["start"] == subdf["start"].max()
-                else:
-                    is_picked = False
-                is_picked_list.append(is_picked)
-        stranddf["is_picked"] = is_picked_list
-        chart = stranddf.loc[stranddf.is_picked == True].copy()
-        summary = pd.concat([summary, chart], ignore_index=True, sort=False)
-    summary = summary.sort_values(by=['start'])
-    summary = summary.sort_values(by=['contig'])
-    summary = summary.drop(["ID", "is_greatest", "is_picked"], 1)
+            partitions = {(str(contig), strand)
+                          for contig, strand in partitions}
+    # the state is only valid for the gff files that are written now
+    if os.path.exists(state_file):
+        os.remove(state_file)
+    lines = alldfs
+    if partitions is not None:
+        lines = alldfs.loc[is_in(alldfs, partitions)]
+        print("Clustering {} of {} contig and strand partitions...".format(
+              len(lines.drop_duplicates(["contig", "strand"])),
+              len(alldfs.drop_duplicates(["contig", "strand"]))))
+    # the positions are only clustered with those of the same contig and
+    # strand, so a cluster also starts at the first line of every partition
+    lines = lines.sort_values(by=["contig", "strand", "start"], kind="stable")
+    contig = lines["contig"].to_numpy()
+    strand = lines["strand"].to_numpy()
+    is_new = np.ones(len(lines), dtype=bool)
+    is_new[1:] = (contig[1:] != contig[:-1]) | (strand[1:] != strand[:-1])
+    leftmost = (((strand == "-") & (args.feature == "tes"))
+                | ((strand == "+") & (args.feature == "tss")))
+    chunks = chunk_bounds(is_new, args.threads)
+    with sharing(start=lines["start"].to_numpy(),
+                 score=lines["score"].to_numpy(),
+                 wobble=args.wobble,
+                 leftmost=leftmost,
+                 is_new=is_new):
+        masks = map_forked(cluster_chunk, chunks, args.threads)
+    summary = pd.DataFrame(columns=GFF_COLUMNS)
+    if masks:
+        # the strands of a contig are merged by start
+        summary = sort_lines(lines.loc[np.concatenate(masks)])
     ts = summary.loc[summary.feature == "Template-switching"]
-    ts.to_csv("{}_ts_{}.gff3".format(args.prefix, args.feature + "w" 
-              + str(args.wobble)),
+    feature = summary.loc[summary.feature == args.feature]
+    if partitions is not None:
+        ts = splice(ts_file, ts, partitions, args)
+        feature = splice(feature_file, feature, partitions, args)
+    ts.to_csv(ts_file,
               index=False,
               header=False,
               sep="\t")
-    feature = summary.loc[summary.feature == args.feature]
-    feature.to_csv("{}_not_ts_{}.gff3".format(args.prefix, args.feature),
+    feature.to_csv(feature_file,
                    index=False,
                    header=False,
                    sep="\t")
+    if getattr(args, "incremental", False):
+        with open(state_file, "w") as sfile:
+            json.dump(state, sfile)
 
 
 ###############################################################################
@@ -123,7 +252,8 @@ def ts_gff(args):
 
 def main():
     args = parsing()
-    ts_gff(args)
+    with profiling(args.profile_report, args.profile_dump):
+        ts_gff(args)
 
 def parsing():
     parser = ArgumentParser(description="This is the third module of \
@@ -147,6 +277,34 @@ def parsing():
                         type=int,
                         default=10,
                         metavar="[integer]")
+    parser.add_argument("-p", "--threads",
+                        dest="threads",
+                        help="The number of processes that the clustering of \
+                        the contigs and strands is split between. The \
+                        default value is 1.",
+                        type=int,
+                        default=1,
+                        metavar="[integer]")
+    parser.add_argument("--intermediate_format",
+                        dest="intermediate_format",
+                        help="The format of the summary tables, 'tsv' or \
+                        'parquet'. The default is 'tsv'.",
+                        choices=["tsv", "parquet"],
+                        default="tsv",
+                        metavar="[tsv|parquet]")
+    parser.add_argument("--profile_report", "--profile-report",
+                        dest="profile_report",
+                        help="Write the wall time, CPU time, peak memory and \
+                        number of rows of each stage and contig to this json \
+                        file.",
+                        default=None,
+                        metavar="[file]")
+    parser.add_argument("--profile_dump", "--profile-dump",
+                        dest="profile_dump",
+                        help="Profile the functions of the main process with \
+                        cProfile and save the statistics to this file.",
+                        default=None,
+                        metavar="[file]")
     return parser.parse_args()
 
 
@@ -1,25 +1,103 @@
 #!/usr/bin/env python3
+import multiprocessing
 import os
 from argparse import ArgumentParser
 import ts_gff
 import deal_with_ts
+from ts_coverage import open_coverage
+from ts_profile import profiling, stage
+from ts_reference import Reference
 
-def main():
-    args = parsing()
+def send_pass(connection, args, changes):
+    """
+    Runs a strand pass and sends its changed contigs to the parent process.
+    """
+    connection.send(deal_with_ts.Stats(args, **changes))
+    connection.close()
+
+def run_passes(args, passes):
+    """
+    Runs the strand passes side by side on forked processes if more than one
+    thread is requested, otherwise one after the other. The threads are
+    split between the passes. Returns the changed contigs of each pass.
+    """
+    if args.threads > 1 and "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        threads = max(1, args.threads // len(passes))
+        pipes = [context.Pipe(duplex=False) for changes in passes]
+        processes = [context.Process(target=send_pass,
+                                     args=(sender, args,
+                                           dict(changes, threads=threads)))
+                     for (receiver, sender), changes in zip(pipes, passes)]
+        for process in processes:
+            process.start()
+        results = []
+        for receiver, sender in pipes:
+            sender.close()
+            try:
+                results.append(receiver.recv())
+            except EOFError:
+                results.append(None)
+        for process in processes:
+            process.join()
+        failed = [changes["feature_file"] for process, changes
+                  in zip(processes, passes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError("Processing {} failed.".format(
+                               ", ".join(failed)))
+        return results
+    return [deal_with_ts.Stats(args, **changes) for changes in passes]
 
+def coverage_path(args):
+    """
+    Returns the coverage file of a sample according to the coverage source.
+    """
+    if args.coverage_source == "bam":
+        return args.prefix + "_out_sorted.bam"
+    return args.prefix + "_out_allcov.tsv"
 
-    args.feature_file = args.prefix + "_ts_l3.tsv"
-    args.feature = args.feature_file[-6:-4]
-    args.coverage_file = args.prefix + "_out_allcov.tsv"
-    deal_with_ts.Stats(args)
+def strand_passes(args):
+    """
+    Loads the coverages and the reference index, which are shared by both
+    strands, unless they were already loaded, and returns the changes that
+    define the two strand passes.
+    """
+    coverage_file = coverage_path(args)
+    if getattr(args, "coverage_store", None) is None:
+        with stage("load coverage"):
+            args.coverage_store = open_coverage(
+                coverage_file, getattr(args, "streaming", False))
+    if getattr(args, "reference_store", None) is None:
+        with stage("load reference"):
+            args.reference_store = Reference(args.reference)
+    passes = [{"feature_file": args.prefix + "_ts_{}.tsv".format(feature),
+               "coverage_file": coverage_file,
+               "feature": feature}
+              for feature in ["l3", "r3"]]
+    return passes
+
+def launch(args):
+    """
+    Filters both strands of a sample and creates its gff files.
+    """
+    passes = strand_passes(args)
+    results = run_passes(args, passes)
 
-    args.feature_file = args.prefix + "_ts_r3.tsv"
-    args.feature = args.feature_file[-6:-4]
-    args.coverage_file = args.prefix + "_out_allcov.tsv"
-    deal_with_ts.Stats(args)
-    
     args.feature = "tes"
-    ts_gff.ts_gff(args)
+    partitions = None
+    if getattr(args, "incremental", False) and None not in results:
+        # only the gff lines of the changed contigs of each strand are
+        # clustered again
+        partitions = {(contig, ts_gff.feature_strand(changes["feature"]))
+                      for changes, contigs in zip(passes, results)
+                      for contig in contigs}
+    with stage("gff"):
+        ts_gff.ts_gff(args, partitions)
+
+def main():
+    args = parsing()
+    with profiling(args.profile_report, args.profile_dump):
+        launch(args)
 
 def parsing():
     parser = ArgumentParser(description="This is the deal_with_ts module of \
@@ -30,6 +108,26 @@ def parsing():
                         help="The path and the prefix of the statistics, \
                         which are to be used for the gff.",
                         metavar="prefix")
+    add_options(parser)
+    parser.add_argument("--profile_report", "--profile-report",
+                        dest="profile_report",
+                        help="Write the wall time, CPU time, peak memory and \
+                        number of rows of each stage and contig to this json \
+                        file.",
+                        default=None,
+                        metavar="[file]")
+    parser.add_argument("--profile_dump", "--profile-dump",
+                        dest="profile_dump",
+                        help="Profile the functions of the main process with \
+                        cProfile and save the statistics to this file.",
+                        default=None,
+                        metavar="[file]")
+    return parser.parse_args()
+
+def add_options(parser):
+    """
+    Adds the filtering options, which are shared with the batch module.
+    """
     parser.add_argument("-r", "--reference",
                         dest="reference",
                         help="The reference fasta file. Template-switching \
@@ -107,6 +205,68 @@ def parsing():
                         use a different file.",
                         default=(str(os.path.abspath(__file__)).replace("ts_launcher.py",""))+"dict.tsv",
                         metavar="[file_with_the_limit_values]")
+    parser.add_argument("-c", "--coverage_source",
+                        dest="coverage_source",
+                        help="Where the coverages are read from. 'tsv' reads \
+                        the prefix_out_allcov.tsv file, 'bam' reads the \
+                        indexed prefix_out_sorted.bam file only around the \
+                        feature positions. The default is 'tsv'.",
+                        choices=["tsv", "bam"],
+                        default="tsv",
+                        metavar="[tsv|bam]")
+    parser.add_argument("-p", "--threads",
+                        dest="threads",
+                        help="The number of processes that the contigs are \
+                        distributed between. The default value is 1.",
+                        type=int,
+                        default=1,
+                        metavar="[integer]")
+    parser.add_argument("--cache_dir",
+                        dest="cache_dir",
+                        help="A directory where the processed tables of the \
+                        contigs are cached. Reruns with the same inputs and \
+                        settings, apart from the thresholds of the \
+                        classification, reuse them. By default nothing is \
+                        cached.",
+                        default=None,
+                        metavar="[directory]")
+    parser.add_argument("--cache_size",
+                        dest="cache_size",
+                        help="The size limit of the cache directory in MB. \
+                        The least recently used tables are removed above it.\
+                        The default value is 10240.",
+                        type=int,
+                        default=10240,
+                        metavar="[integer]")
+    parser.add_argument("--streaming",
+                        dest="streaming",
+                        help="Process the contigs one at a time, reading only \
+                        the lines of the current contig from the feature, \
+                        count and coverage files, and append the results to \
+                        the output. This keeps the memory use bounded by the \
+                        largest contig. The input files have to be sorted by \
+                        contig. The cache directory is not used.",
+                        action="store_true")
+    parser.add_argument("--incremental",
+                        dest="incremental",
+                        help="Keep a fingerprint of the counts, coverages \
+                        and reference sequence of every contig next to the \
+                        summary table, and on later runs with the same \
+                        settings only process the contigs whose \
+                        fingerprints have changed. Their rows are spliced \
+                        into the existing summary table. This is not used \
+                        with --streaming.",
+                        action="store_true")
+    parser.add_argument("--intermediate_format",
+                        dest="intermediate_format",
+                        help="The format of the summary tables, 'tsv' or \
+                        'parquet'. Parquet tables have one row group per \
+                        contig, and only the columns that are needed for the \
+                        gff files are read from them. This requires the \
+                        pyarrow package. The default is 'tsv'.",
+                        choices=["tsv", "parquet"],
+                        default="tsv",
+                        metavar="[tsv|parquet]")
     parser.add_argument("-g", "--check_surroundings",
                         dest="check_surroundings",
                         help="The number of nucleotides surrounding the \
@@ -115,7 +275,6 @@ def parsing():
                         type=int,
                         default=10,
                         metavar="[integer]")
-    return parser.parse_args()    
 
 if __name__== "__main__":
     main()
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import sys
+
+def lazy_import(name):
+    """
+    Returns a module that is only loaded when one of its attributes is first
+    used, so that the command line can be parsed and empty inputs can be
+    skipped without waiting for numpy and pandas to load. Missing modules
+    are still reported at once.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named '{}'".format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+from contextlib import contextmanager
+
+# The read-only data of the current run. Worker processes inherit it through
+# fork, so it does not have to be pickled.
+shared = {}
+
+@contextmanager
+def sharing(**data):
+    """
+    Shares the given data with the functions that are mapped inside the
+    block, and removes it afterwards.
+    """
+    shared.update(data)
+    try:
+        yield shared
+    finally:
+        shared.clear()
+
+def imap_forked(function, items, threads):
+    """
+    Maps a function over the items and yields the results in the order of
+    the items, on a pool of forked processes if more than one thread is
+    requested.
+    """
+    if (threads > 1 and len(items) > 1
+            and "fork" in multiprocessing.get_all_start_methods()):
+        context = multiprocessing.get_context("fork")
+        with context.Pool(min(threads, len(items))) as pool:
+            yield from pool.imap(function, items, chunksize=1)
+    else:
+        for item in items:
+            yield function(item)
+
+def map_forked(function, items, threads):
+    return list(imap_forked(function, items, threads))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import cProfile
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+# The state of the running profile, or None if profiling is off. Forked
+# worker processes inherit it and write their records into their own files.
+_state = None
+
+class _Off:
+    """
+    The stage of a run without profiling, which does nothing.
+    """
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exception):
+        return False
+
+_OFF = _Off()
+
+def peak_memory():
+    """
+    Returns the peak resident memory of the process in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024 ** 2
+    return peak / 1024
+
+def children_peak_memory():
+    """
+    Returns the largest peak resident memory of the finished child
+    processes in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024 ** 2
+    return peak / 1024
+
+class _Stage:
+    def __init__(self, name, contig, rows, fields):
+        self.record = dict(fields, stage=name, contig=contig, rows=rows)
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self.record
+
+    def __exit__(self, *exception):
+        wall = time.perf_counter()
+        self.record.update(pid=os.getpid(),
+                           start=self.wall - _state["start"],
+                           wall=wall - self.wall,
+                           cpu=time.process_time() - self.cpu,
+                           peak_rss_mb=peak_memory(),
+                           failed=exception[0] is not None)
+        path = os.path.join(_state["parts"], "{}.jsonl".format(os.getpid()))
+        with open(path, "a") as pfile:
+            pfile.write(json.dumps(self.record) + "\n")
+        return False
+
+def stage(name, contig=None, rows=None, **fields):
+    """
+    Returns a context manager that records the wall time, the CPU time, the
+    peak memory and the number of rows of a stage, along with any other
+    fields. The rows can also be set in the yielded record. Without
+    profiling it does nothing.
+    """
+    if _state is None:
+        return _OFF
+    return _Stage(name, contig, rows, fields)
+
+def summarize(records):
+    """
+    Sums the records of each stage over the contigs and the processes.
+    """
+    summary = {}
+    for record in records:
+        total = summary.setdefault(record["stage"], {"calls": 0,
+                                                     "wall": 0.0,
+                                                     "cpu": 0.0,
+                                                     "rows": 0,
+                                                     "peak_rss_mb": 0.0})
+        total["calls"] += 1
+        total["wall"] += record["wall"]
+        total["cpu"] += record["cpu"]
+        total["rows"] += record["rows"] or 0
+        total["peak_rss_mb"] = max(total["peak_rss_mb"],
+                                   record["peak_rss_mb"])
+    return summary
+
+@contextmanager
+def profiling(report=None, dump=None):
+    """
+    Profiles the stages that run inside the block, including those on forked
+    processes, and writes them to a json report. If dump is given, the
+    functions of the main process are also profiled with cProfile and the
+    statistics are saved there for pstats or snakeviz.
+    """
+    global _state
+    if report is None and dump is None:
+        yield
+        return
+    profiler = None
+    if dump is not None:
+        profiler = cProfile.Profile()
+    _state = {"start": time.perf_counter(),
+              "parts": tempfile.mkdtemp(prefix="ts_profile_",
+                                        dir=os.path.dirname(
+                                            os.path.abspath(report or dump)))}
+    cpu = time.process_time()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(dump)
+        records = []
+        for name in sorted(os.listdir(_state["parts"])):
+            with open(os.path.join(_state["parts"], name)) as pfile:
+                records.extend(json.loads(line) for line in pfile)
+        records.sort(key=lambda record: record["start"])
+        wall = time.perf_counter() - _state["start"]
+        shutil.rmtree(_state["parts"])
+        _state = None
+        if report is not None:
+            with open(report, "w") as rfile:
+                json.dump({"command": sys.argv,
+                           "wall": wall,
+                           "cpu": time.process_time() - cpu,
+                           "peak_rss_mb": peak_memory(),
+                           "children_peak_rss_mb": children_peak_memory(),
+                           "summary": summarize(records),
+                           "stages": records},
+                          rfile,
+                          indent=2)
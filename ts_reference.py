@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import hashlib
+import mmap
+import os
+from ts_coverage import read_arrays
+from ts_lazy import lazy_import
+
+np = lazy_import("numpy")
+
+TRACK_MAGIC = b"TSATRK\x00\x01"
+
+# The A count track covers the positions from 0 to the end of the contig and
+# this far past it, where the upstream window of the forward strand still
+# overlaps the contig.
+TRACK_OVERHANG = 21
+
+def build_index(fasta):
+    """
+    Scans a fasta file and returns a samtools-style .fai index as a dict of
+    contig: (length, offset, linebases, linewidth).
+    """
+    index = {}
+    name = None
+    with open(fasta, "rb") as ffile:
+        offset = 0
+        for line in ffile:
+            if line.startswith(b">"):
+                name = line[1:].split()[0].decode()
+                index[name] = [0, offset + len(line), 0, 0]
+                last_line = False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                entry = index[name]
+                if entry[2] == 0:
+                    entry[2] = bases
+                    entry[3] = len(line)
+                elif last_line or bases > entry[2]:
+                    raise ValueError("Different line lengths in contig {} "
+                                     "of {}.".format(name, fasta))
+                last_line = bases < entry[2]
+                entry[0] += bases
+            offset += len(line)
+    return {name: tuple(entry) for name, entry in index.items()}
+
+def write_index(index, fai):
+    with open(fai, "w") as ffile:
+        for name, entry in index.items():
+            ffile.write("\t".join([name] + [str(i) for i in entry]) + "\n")
+
+def read_index(fai):
+    index = {}
+    with open(fai) as ffile:
+        for line in ffile:
+            fields = line.rstrip("\n").split("\t")
+            index[fields[0]] = tuple(int(i) for i in fields[1:5])
+    return index
+
+def track_path(fasta):
+    return fasta + ".atrack"
+
+def track_key(contig, strand):
+    """
+    Returns the name of the track of a contig and strand in the track file.
+    """
+    if strand < 0:
+        return "-" + contig
+    return "+" + contig
+
+def load_track(fasta):
+    """
+    Memory-maps the A count track of a fasta file if it exists and is newer
+    than the fasta, otherwise returns None.
+    """
+    track = track_path(fasta)
+    if (os.path.exists(track)
+            and os.path.getmtime(track) >= os.path.getmtime(fasta)):
+        return read_arrays(track, TRACK_MAGIC)
+    return None
+
+def load_index(fasta):
+    """
+    Returns the index of a fasta file. The index is read from the .fai file
+    next to the fasta if it is up to date, otherwise it is built and cached
+    there for later runs.
+    """
+    fai = fasta + ".fai"
+    if (os.path.exists(fai)
+            and os.path.getmtime(fai) >= os.path.getmtime(fasta)):
+        return read_index(fai)
+    index = build_index(fasta)
+    try:
+        write_index(index, fai)
+    except OSError:
+        pass
+    return index
+
+class Reference:
+    """
+    Random access to the sequences of a memory-mapped fasta file, so that
+    short regions can be read without loading whole contigs.
+    """
+    def __init__(self, fasta):
+        self.fasta = fasta
+        self.index = load_index(fasta)
+        with open(fasta, "rb") as ffile:
+            self.map = mmap.mmap(ffile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = np.frombuffer(self.map, dtype=np.uint8)
+        self.track = load_track(fasta)
+
+    def length(self, contig):
+        return self.index[contig][0]
+
+    def offset(self, contig, position):
+        """
+        Returns the byte offset of a 0-based position of a contig.
+        """
+        length, offset, linebases, linewidth = self.index[contig]
+        return offset + position // linebases * linewidth + position % linebases
+
+    def a_track(self, contig, strand):
+        """
+        Returns the precomputed A counts of every position of a contig and
+        strand, or None if there is no track.
+        """
+        if self.track is None:
+            return None
+        return self.track.get(track_key(contig, strand))
+
+    def fingerprint(self, contig):
+        """
+        Returns a hash of the sequence of a contig as it is laid out in the
+        fasta file.
+        """
+        if contig not in self.index or self.length(contig) == 0:
+            return ""
+        start = self.offset(contig, 0)
+        end = self.offset(contig, self.length(contig) - 1) + 1
+        return hashlib.sha256(memoryview(self.map)[start:end]).hexdigest()
+
+    def bases(self, contig, positions):
+        """
+        Gathers the bases at an array of 0-based positions of a contig as
+        uint8 character codes. Positions outside the contig are 0.
+        """
+        if contig not in self.index:
+            raise KeyError("Contig {} is not in the reference {}.".format(
+                           contig, self.fasta))
+        length, offset, linebases, linewidth = self.index[contig]
+        positions = np.asarray(positions, dtype=np.int64)
+        inside = (positions >= 0) & (positions < length)
+        codes = np.zeros(positions.shape, dtype=np.uint8)
+        inner = positions[inside]
+        codes[inside] = self.buffer[offset + inner // linebases * linewidth
+                                    + inner % linebases]
+        return codes
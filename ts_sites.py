@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+from ts_lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# The codes of the feature column of a site table
+NO_FEATURE = 0
+FEATURE = 1
+TEMPLATE_SWITCHING = 2
+
+def feature_labels(feature):
+    """
+    Returns the labels of the feature codes of a feature type, which are
+    written to the summary tables.
+    """
+    if feature[1] == "3":
+        labels = [None, "tes", "Template-switching"]
+    else:
+        labels = [None, "tss", "tss Template-switching"]
+    return np.array(labels, dtype=object)
+
+def position_dtype(positions):
+    """
+    Returns int32 for the positions, or int64 for very long contigs.
+    """
+    if len(positions) and max(-positions.min(), positions.max()) >= 2 ** 31:
+        return np.dtype(np.int64)
+    return np.dtype(np.int32)
+
+def count_dtype(counts):
+    """
+    Returns the smallest unsigned integer type that holds the read counts.
+    """
+    if len(counts) == 0:
+        return np.dtype(np.uint8)
+    return np.min_scalar_type(int(counts.max()))
+
+def code_dtype(contigs):
+    """
+    Returns the smallest unsigned integer type of the codes of the contigs.
+    """
+    return np.min_scalar_type(max(len(contigs) - 1, 0))
+
+class SiteTable:
+    """
+    The potential feature positions as a struct of arrays: the contigs are
+    coded by their index in the contigs list, the positions are int32, the
+    counts and the window counts use the smallest unsigned type of the
+    counts, the A counts are int8 (-2 for the positions that were not
+    counted) and the features are uint8 codes. The ratio and the window sums
+    are calculated when they are needed, and the table is converted to a
+    dataframe with the columns of the summary table only for the output.
+    """
+    def __init__(self, contigs, columns):
+        self.contigs = list(contigs)
+        self.columns = dict(columns)
+
+    @classmethod
+    def from_counts(cls, contig, positions, counts):
+        """
+        Returns the table of the positions and counts of one contig.
+        """
+        return cls([contig],
+                   {"pos": positions.astype(position_dtype(positions)),
+                    "count": counts.astype(count_dtype(counts)),
+                    "contig": np.zeros(len(positions), dtype=np.uint8)})
+
+    def __len__(self):
+        return len(self.columns["pos"])
+
+    def __getitem__(self, name):
+        if name == "ratio":
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return self.columns["count"] / self.columns["coverage_before"]
+        if name in ["fsum", "rsum"]:
+            return self.columns[name[0]].sum(axis=1, dtype=np.int64)
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        self.columns[name] = values
+
+    def take(self, rows):
+        """
+        Returns the table of the selected rows, given as an index array or
+        as a boolean mask.
+        """
+        return SiteTable(self.contigs, {name: values[rows] for name, values
+                                        in self.columns.items()})
+
+    def contig_names(self):
+        """
+        Returns the contig of every row.
+        """
+        return np.array(self.contigs, dtype=object)[self.columns["contig"]]
+
+    def contig_rows(self):
+        """
+        Yields each contig of the table with the mask of its rows.
+        """
+        codes = self.columns["contig"]
+        for code, contig in enumerate(self.contigs):
+            rows = codes == code
+            if rows.any():
+                yield contig, rows
+
+    def to_frame(self, labels=None):
+        """
+        Returns the table as a dataframe with the columns and the integer
+        types of the summary tables. The feature codes are replaced by the
+        given labels.
+        """
+        frame = {}
+        for name, values in self.columns.items():
+            if name == "contig":
+                frame[name] = self.contig_names()
+                continue
+            if name == "is_qualified":
+                frame["ratio"] = self["ratio"]
+            if name == "feature" and labels is not None:
+                frame[name] = labels[values]
+            elif values.ndim == 2:
+                surroundings = (values.shape[1] - 1) // 2
+                for number in range(values.shape[1]):
+                    frame[name + str(number - surroundings)] = (
+                        values[:, number].astype(np.int64))
+                frame[name + "sum"] = self[name + "sum"]
+            elif values.dtype.kind in "iu":
+                frame[name] = values.astype(np.int64)
+            else:
+                frame[name] = values
+        return pd.DataFrame(frame)
+
+def concat_sites(tables):
+    """
+    Concatenates site tables that have the same columns.
+    """
+    contigs = []
+    codes = {}
+    recoded = []
+    for table in tables:
+        for contig in table.contigs:
+            if contig not in codes:
+                codes[contig] = len(contigs)
+                contigs.append(contig)
+        mapping = np.array([codes[contig] for contig in table.contigs],
+                           dtype=np.int64)
+        recoded.append(mapping[table.columns["contig"]])
+    if not tables:
+        return SiteTable([], {"pos": np.zeros(0, dtype=np.int32),
+                              "count": np.zeros(0, dtype=np.uint8),
+                              "contig": np.zeros(0, dtype=np.uint8)})
+    columns = {name: np.concatenate([table.columns[name]
+                                     for table in tables])
+               for name in tables[0].columns}
+    columns["contig"] = np.concatenate(recoded).astype(code_dtype(contigs))
+    return SiteTable(contigs, columns)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+def count_contig(line):
+    """
+    Returns the contig of a ('contig', position)<tab>count line.
+    """
+    key = line.split(b"\t", 1)[0].strip()
+    if not key:
+        return None
+    return key[1:-1].rsplit(b",", 1)[0].strip()[1:-1].decode()
+
+def tsv_contig(line):
+    """
+    Returns the contig of a contig<tab>position<tab>coverage line.
+    """
+    contig = line.split(b"\t", 1)[0].strip()
+    if not contig:
+        return None
+    return contig.decode()
+
+def contig_blocks(path, contig_of):
+    """
+    Scans a file that is sorted by contig and returns the contig: (start,
+    end) byte offsets of the lines of each contig, so that the contigs can be
+    read one by one later.
+    """
+    starts = {}
+    ends = {}
+    current = None
+    offset = 0
+    with open(path, "rb") as sfile:
+        for line in sfile:
+            contig = contig_of(line)
+            if contig is not None and contig != current:
+                if contig in starts:
+                    raise ValueError("{} is not sorted by contig: {} appears "
+                                     "in more than one block.".format(
+                                     path, contig))
+                if current is not None:
+                    ends[current] = offset
+                starts[contig] = offset
+                current = contig
+            offset += len(line)
+    if current is not None:
+        ends[current] = offset
+    return {contig: (starts[contig], ends[contig]) for contig in starts}
+
+def read_block(path, block):
+    """
+    Returns the bytes of a block of a file.
+    """
+    start, end = block
+    with open(path, "rb") as sfile:
+        sfile.seek(start)
+        return sfile.read(end - start)
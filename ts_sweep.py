@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import itertools
+import os
+from argparse import ArgumentParser
+from functools import partial
+import deal_with_ts
+import ts_launcher
+from ts_lazy import lazy_import
+from ts_sites import FEATURE, concat_sites, feature_labels
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+def add_picked_As(table, args):
+    """
+    Counts the As upstream of every picked position. The qualified positions
+    of any minimum and ratio setting are among these.
+    """
+    table["A_list"] = deal_with_ts.site_As(table, args, table["is_picked"])
+    return table
+
+def evaluate(table, picked_As, point, limits):
+    """
+    Classifies the positions of a strand with one setting of the grid and
+    returns the qualified mask, the A counts and the feature codes.
+    """
+    minimum, ratio, multiplier, dictionary = point
+    qualified = deal_with_ts.check_if_qualified(table, minimum, ratio)
+    A_list = np.where(qualified, picked_As, -2)
+    feat_list = deal_with_ts.decide(table, A_list, qualified, multiplier,
+                                    limits[dictionary])
+    return qualified, A_list, feat_list
+
+def sweep(args):
+    """
+    Calculates the features that do not depend on the minimum, ratio,
+    multiplier and dictionary settings once for each strand, then classifies
+    the positions with every combination of the given settings.
+    """
+    points = list(itertools.product(args.minimum,
+                                    args.ratio,
+                                    args.multiplier,
+                                    args.dictionary))
+    limits = {dictionary: deal_with_ts.limit_table(dictionary)
+              for dictionary in args.dictionary}
+    passes = ts_launcher.strand_passes(args)
+    rows = []
+    for changes in passes:
+        config = deal_with_ts.pass_config(args,
+                                          minimum=args.minimum[0],
+                                          ratio=args.ratio[0],
+                                          multiplier=args.multiplier[0],
+                                          dictionary=args.dictionary[0],
+                                          **changes)
+        if os.stat(config.feature_file).st_size == 0:
+            print("Feature file {} is empty. There is nothing to do "
+                  "here.".format(config.feature_file))
+            continue
+        print("Calculating {} features for {} settings...".format(
+              config.feature, len(points)))
+        table = concat_sites(deal_with_ts.site_table(
+            config, partial(add_picked_As, args=config)))
+        picked_As = table["A_list"]
+        labels = feature_labels(config.feature)
+        label = labels[FEATURE]
+        for number, point in enumerate(points):
+            qualified, A_list, feat_list = evaluate(table, picked_As, point,
+                                                    limits)
+            features = int(np.sum(feat_list == FEATURE))
+            rows.append([number, config.feature] + list(point)
+                        + [int(qualified.sum()),
+                           features,
+                           int(qualified.sum()) - features])
+            if args.calls:
+                calls = pd.DataFrame({
+                    "contig": table.contig_names()[qualified],
+                    "pos": table["pos"][qualified],
+                    "count": table["count"][qualified],
+                    "A_list": A_list[qualified],
+                    "feature": labels[feat_list[qualified]]})
+                calls.to_csv(config.feature_file.replace(
+                             ".tsv", "_{}_sweep{}.tsv".format(label, number)),
+                             index=False,
+                             sep="\t")
+    summary = pd.DataFrame(rows, columns=["setting",
+                                          "feature",
+                                          "minimum",
+                                          "ratio",
+                                          "multiplier",
+                                          "dictionary",
+                                          "qualified",
+                                          "features",
+                                          "template_switching"])
+    summary.to_csv(args.prefix + "_ts_sweep.tsv", index=False, sep="\t")
+
+###############################################################################
+###                             Main function                               ###
+###############################################################################
+
+def main():
+    args = parsing()
+    sweep(args)
+
+def parsing():
+    parser = ArgumentParser(description="This module runs the \
+                            template-switching filter with every combination\
+                            of the given minimum, ratio, multiplier and \
+                            dictionary settings. The coverages, the window \
+                            counts and the A counts are only calculated once.\
+                            The number of accepted and template-switching \
+                            sites of each setting is written to \
+                            prefix_ts_sweep.tsv.")
+    parser.add_argument("prefix",
+                        help="The path and the prefix of the statistics, \
+                        which are to be used for the gff.",
+                        metavar="prefix")
+    parser.add_argument("-r", "--reference",
+                        dest="reference",
+                        help="The reference fasta file.",
+                        default="/mnt/c/Work/LT907985.2/Ref/LT907985.2.fasta",
+                        metavar="[reference_fasta]")
+    parser.add_argument("-m", "--minimum",
+                        dest="minimum",
+                        help="The minimal numbers of reads for the feature to\
+                        be accepted. The default value is 2.",
+                        type=int,
+                        nargs="+",
+                        default=[2],
+                        metavar="[integer]")
+    parser.add_argument("-t", "--ratio",
+                        dest="ratio",
+                        help="The minimal ratios of the coverage that a \
+                        feature has to reach to be accepted. The default value\
+                        is 0.001.",
+                        type=float,
+                        nargs="+",
+                        default=[0.001],
+                        metavar="[float]")
+    parser.add_argument("-l", "--multiplier",
+                        dest="multiplier",
+                        help="The multipliers of the reads that could not \
+                        have been produced by template switching. The default\
+                        value is 1.0.",
+                        type=float,
+                        nargs="+",
+                        default=[1.0],
+                        metavar="[float]")
+    parser.add_argument("-y", "--dictionary",
+                        dest="dictionary",
+                        help="The .tsv files that contain the percentage of \
+                        overlapping reads that have to support a potential \
+                        polyA site in order for it to be accepted as a TES.\
+                        By default the dict.tsv next to this script is used.",
+                        nargs="+",
+                        default=[(str(os.path.abspath(__file__)).replace(
+                                 "ts_sweep.py", "")) + "dict.tsv"],
+                        metavar="[file_with_the_limit_values]")
+    parser.add_argument("-b", "--wobble",
+                        dest="wobble",
+                        help="The window, in which only one of each feature \
+                        is expected. The default value is 10.",
+                        type=int,
+                        default=10,
+                        metavar="[integer]")
+    parser.add_argument("-d", "--distance",
+                        dest="distance",
+                        help="The distance from the feature position where \
+                        coverage should be calculated. The default value is \
+                        15.",
+                        type=int,
+                        default=15,
+                        metavar="[integer]")
+    parser.add_argument("--cov_sample",
+                        dest="cov_sample",
+                        help="The number of nucleotides where the coverage \
+                        should be averaged. The default value is 5.",
+                        type=int,
+                        default=5,
+                        metavar="[integer]")
+    parser.add_argument("--cache_dir",
+                        dest="cache_dir",
+                        help="A directory where the processed tables of the \
+                        contigs are cached. Reruns with the same inputs and \
+                        settings, apart from the thresholds of the \
+                        classification, reuse them. By default nothing is \
+                        cached.",
+                        default=None,
+                        metavar="[directory]")
+    parser.add_argument("--cache_size",
+                        dest="cache_size",
+                        help="The size limit of the cache directory in MB. \
+                        The least recently used tables are removed above it.\
+                        The default value is 10240.",
+                        type=int,
+                        default=10240,
+                        metavar="[integer]")
+    parser.add_argument("-g", "--check_surroundings",
+                        dest="check_surroundings",
+                        help="The number of nucleotides surrounding the \
+                        feature where the number of real and ts hits are \
+                        to be compared. The default value is 10.",
+                        type=int,
+                        default=10,
+                        metavar="[integer]")
+    parser.add_argument("-c", "--coverage_source",
+                        dest="coverage_source",
+                        help="Where the coverages are read from, 'tsv' or \
+                        'bam'. The default is 'tsv'.",
+                        choices=["tsv", "bam"],
+                        default="tsv",
+                        metavar="[tsv|bam]")
+    parser.add_argument("-p", "--threads",
+                        dest="threads",
+                        help="The number of processes that the contigs are \
+                        distributed between. The default value is 1.",
+                        type=int,
+                        default=1,
+                        metavar="[integer]")
+    parser.add_argument("--calls",
+                        dest="calls",
+                        help="Also write the qualified sites and their calls \
+                        of each setting to prefix_ts_[l3|r3]_tes_sweep[n].tsv\
+                        files.",
+                        action="store_true")
+    return parser.parse_args()
+
+
+if __name__== "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+from ts_lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+EXTENSIONS = {"tsv": ".tsv", "parquet": ".parquet"}
+
+def import_parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet tables require the pyarrow package.")
+    return pyarrow, pyarrow.parquet
+
+class TableWriter:
+    """
+    Writes a summary table contig by contig, either as a tsv or as a parquet
+    file with one row group per contig, so that the contigs can be read on
+    their own later.
+    """
+    def __init__(self, path, table_format="tsv"):
+        self.path = path
+        self.table_format = table_format
+        self.file = None
+        self.writer = None
+        self.schema = None
+
+    def write(self, df):
+        if self.table_format == "parquet":
+            self.write_parquet(df)
+        else:
+            if self.file is None:
+                self.file = open(self.path, "w")
+                df.to_csv(self.file, index=False, sep="\t")
+            else:
+                df.to_csv(self.file, index=False, sep="\t", header=False)
+
+    def write_parquet(self, df):
+        pyarrow, parquet = import_parquet()
+        if self.schema is None:
+            schema = pyarrow.Schema.from_pandas(df, preserve_index=False)
+            # a column that is empty on the first contig, like the features
+            # of a contig without qualified positions, holds strings
+            for number, field in enumerate(schema):
+                if pyarrow.types.is_null(field.type):
+                    schema = schema.set(number, field.with_type(
+                                        pyarrow.string()))
+            self.schema = schema
+            self.writer = parquet.ParquetWriter(self.path, self.schema)
+        self.writer.write_table(pyarrow.Table.from_pandas(
+            df, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+        return False
+
+def read_table(path, table_format="tsv", columns=None, contigs=None):
+    """
+    Reads the given columns of a summary table, or all of them. If contigs
+    are given, only their rows are returned, and only their row groups are
+    read from a parquet file.
+    """
+    if table_format == "parquet":
+        pyarrow, parquet = import_parquet()
+        pfile = parquet.ParquetFile(path)
+        groups = list(range(pfile.num_row_groups))
+        if contigs is not None:
+            contigs = set(contigs)
+            column = pfile.schema_arrow.get_field_index("contig")
+            groups = [group for group in groups
+                      if pfile.metadata.row_group(group).column(column)
+                      .statistics.min in contigs]
+        return pfile.read_row_groups(groups, columns=columns).to_pandas()
+    df = pd.read_csv(path,
+                     sep="\t",
+                     usecols=columns,
+                     dtype={"contig": str},
+                     float_precision="round_trip")
+    if contigs is not None:
+        df = df.loc[df["contig"].isin(contigs)]
+    return df
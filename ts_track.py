@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import os
+from argparse import ArgumentParser
+from types import SimpleNamespace
+from deal_with_ts import get_As
+from ts_coverage import write_pieces
+from ts_lazy import lazy_import
+from ts_reference import (TRACK_MAGIC, TRACK_OVERHANG, Reference, track_key,
+                          track_path)
+
+np = lazy_import("numpy")
+
+def track_pieces(reference, strand, chunksize):
+    """
+    Yields the A counts of every position of every contig of a strand, chunk
+    by chunk, as (track name, uint8 array) pairs.
+    """
+    args = SimpleNamespace(strand=strand)
+    for contig in reference.index:
+        length = reference.length(contig) + TRACK_OVERHANG
+        for start in range(0, length, chunksize):
+            positions = np.arange(start, min(start + chunksize, length))
+            yield (track_key(contig, strand),
+                   get_As(reference, contig, positions, args).astype(np.uint8))
+
+def build_track(fasta, chunksize=1000000):
+    """
+    Counts the As upstream of every position of both strands of a reference
+    and saves them next to the fasta. The counts are at most 20, so one byte
+    is stored per position and strand.
+    """
+    reference = Reference(fasta)
+    # the counts have to be calculated, not read from an outdated track
+    reference.track = None
+    lengths = {}
+    for strand in [1, -1]:
+        for contig in reference.index:
+            lengths[track_key(contig, strand)] = (reference.length(contig)
+                                                  + TRACK_OVERHANG)
+    pieces = (piece for strand in [1, -1]
+              for piece in track_pieces(reference, strand, chunksize))
+    temporary = "{}.{}.tmp".format(track_path(fasta), os.getpid())
+    write_pieces(temporary, lengths, pieces, np.uint8, TRACK_MAGIC)
+    os.replace(temporary, track_path(fasta))
+
+###############################################################################
+###                             Main function                               ###
+###############################################################################
+
+def main():
+    args = parsing()
+    print("Counting the As of {}...".format(args.reference))
+    build_track(args.reference, args.chunksize)
+
+def parsing():
+    parser = ArgumentParser(description="This module counts the As upstream \
+                            of every position of both strands of a reference \
+                            once, and saves the counts next to the fasta as \
+                            reference.fasta.atrack. Later runs on samples \
+                            mapped to this reference look the A counts up \
+                            instead of counting them.")
+    parser.add_argument("reference",
+                        help="The reference fasta file.",
+                        metavar="reference")
+    parser.add_argument("--chunksize",
+                        dest="chunksize",
+                        help="The number of positions that are counted at \
+                        once. The default value is 1000000.",
+                        type=int,
+                        default=1000000,
+                        metavar="[integer]")
+    return parser.parse_args()
+
+
+if __name__== "__main__":
+    main()